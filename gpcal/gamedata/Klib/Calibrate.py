@@ -0,0 +1,763 @@
+"""
+    Calibrate: guided calibration of the sticks and triggers
+    Author: Kdog
+    Version: 0.1
+    SPDX-License-Identifier: MIT
+"""
+import bisect
+import math
+from array import array
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from Klib.Evdev import ABS_X, ABS_Y, ABS_RX, ABS_RY, ABS_HAT2X, ABS_HAT2Y, VECTORIZE_MIN
+
+CALIBRATE_DETECTION_PERCENT=10
+CALIBRATION_DETECTION_TIME = 0.5   # minimum time (s) to maintain a stick / trigger in a position
+CALIBRATE_STABLE_PERCENT=2      # spread of the samples of a position, relative to the range
+CALIBRATE_REPEAT=3              # push and release of each direction
+# adaptive mode: a position is taken as soon as it is accurate enough
+# and a direction needs more or less repetitions depending on the noise
+CALIBRATE_ADAPTIVE=True
+CALIBRATE_TOLERANCE_PERCENT=0.5 # accuracy wanted, relative to the range
+CALIBRATION_MIN_TIME = 0.2      # shortest hold (s)
+CALIBRATE_MIN_REPEAT=2
+CALIBRATE_MAX_REPEAT=5
+AXIS_MAX_PERCENT=95             # correction after calc (error margin)
+AXIS_DEADZONE_PERCENT=150       # correction after calc (error margin), stick rest zone is wide...
+AXIS_DEADZONE_PERCENT_MINI=5
+AXIS_ANTIDEADZONE_PERCENT=80    # 0 to 100 (> 50 to avoid big first step)
+TRIGGER_MAX_PERCENT=100         # correction after calc (error margin)
+TRIGGER_DEADZONE_PERCENT=105    # correction after calc (error margin)
+TRIGGER_ANTIDEADZONE_PERCENT=80 # 0 to 100 (> 50 to avoid big first step)
+
+# Sweep of a stick around its gate: reach of the stick by angle
+GATE_SECTORS=64
+GATE_TIME=2.0               # shortest sweep (s)
+GATE_COVERAGE_PERCENT=60    # a sector is swept once reached past this part of the cardinal reach
+FIT_RIM_PERCENT=90          # samples past this part of the reach of their sector are on the gate
+FIT_TERMS=5                 # A x^2 + B xy + C y^2 + D x + E y = 1
+
+# Estimators of a position from its samples
+MAD_SIGMA=1.4826        # MAD to standard deviation of a normal noise
+OUTLIER_MAD=3.5         # samples further from the median are dropped
+TRIM_PERCENT=10         # cut on each side for the trimmed mean
+CONFIDENCE_Z=1.96       # 95 % confidence interval
+
+STICK="stick"
+TRIGGER="trigger"
+
+# Directions of an axis: sign of the raw value, short and long text
+AXIS_X_DIRECTIONS=((1, "right", "full right"), (-1, "left", "full left"))
+AXIS_Y_DIRECTIONS=((1, "down", "full down"), (-1, "up", "full up"))
+TRIGGER_DIRECTIONS=((1, "max", "to max"),)
+GATE="gate"     # short text of the sweep step, after the directions of a stick
+
+# Controls which can be calibrated
+# name, short text, kind, parameter group, axes calibrated one after
+# the other as (ABS code, parameter prefix, label, directions)
+CONTROLS=(
+    ("stickleft", "L stick", STICK, "axis_left", (
+        (ABS_X, "axis_leftx", "left.x", AXIS_X_DIRECTIONS),
+        (ABS_Y, "axis_lefty", "left.y", AXIS_Y_DIRECTIONS))),
+    ("stickright", "R stick", STICK, "axis_right", (
+        (ABS_RX, "axis_rightx", "right.x", AXIS_X_DIRECTIONS),
+        (ABS_RY, "axis_righty", "right.y", AXIS_Y_DIRECTIONS))),
+    ("triggerleft", "L2", TRIGGER, "trigger_left", (
+        (ABS_HAT2X, "trigger_left", "trigger.left", TRIGGER_DIRECTIONS),)),
+    ("triggerright", "R2", TRIGGER, "trigger_right", (
+        (ABS_HAT2Y, "trigger_right", "trigger.right", TRIGGER_DIRECTIONS),)),
+)
+CONTROL_NAMES=tuple(row[0] for row in CONTROLS)
+CONTROL_INDEX={row[0]: row for row in CONTROLS}
+
+# phases of a step
+HOLD=0      # pushed to the end of the direction
+REST=1      # released
+
+
+def control_steps(kind, axes):
+    # every direction of a control, in order, pushed and released
+    # several times: (axis index, ABS code, parameter prefix, sign, short text, long text)
+    # A stick ends with the sweep of its gate, on both axes.
+    steps = []
+    for axis, (code, prefix, _, directions) in enumerate(axes):
+        for (sign, short, text) in directions:
+            steps.append((axis, code, prefix, sign, short, text))
+    if kind == STICK:
+        steps.append((len(axes), None, None, 0, GATE, "around the gate"))
+    return tuple(steps)
+
+
+def split_samples(samples, codes):
+    # {code: (timestamps, values)} of the samples of the given codes
+    (timestamps, all_codes, values) = samples
+    if np is not None and len(all_codes) >= VECTORIZE_MIN:
+        c = np.frombuffer(all_codes, dtype=np.uint16)
+        t = np.frombuffer(timestamps, dtype=np.float64)
+        v = np.frombuffer(values, dtype=np.int32)
+        split = {}
+        for code in codes:
+            mask = c == code
+            split[code] = (array('d', t[mask].tobytes()), array('i', v[mask].tobytes()))
+        return split
+
+    split = {code: (array('d'), array('i')) for code in codes}
+    for t, code, v in zip(timestamps, all_codes, values):
+        if code in split:
+            split[code][0].append(t)
+            split[code][1].append(v)
+    return split
+
+
+def pair_samples(x, y, last):
+    # (x, y) positions of the stick from the samples of its two axes,
+    # (timestamps, values) each: every sample is paired with the last
+    # value of the other axis, last holds the values before these samples.
+    # The vectorized pairing gives the positions of the X samples then the
+    # ones of the Y samples, not in time order.
+    (tx, vx) = x
+    (ty, vy) = y
+    if np is not None and len(vx) + len(vy) >= VECTORIZE_MIN:
+        tx = np.frombuffer(tx, dtype=np.float64)
+        ty = np.frombuffer(ty, dtype=np.float64)
+        vx = np.frombuffer(vx, dtype=np.int32)
+        vy = np.frombuffer(vy, dtype=np.int32)
+        # last sample of the other axis at or before each sample
+        iy = np.searchsorted(ty, tx, side="right") - 1
+        ix = np.searchsorted(tx, ty, side="right") - 1
+        xs = np.concatenate((vx, np.where(ix >= 0, vx[np.maximum(ix, 0)] if len(vx) else 0, last[0])))
+        ys = np.concatenate((np.where(iy >= 0, vy[np.maximum(iy, 0)] if len(vy) else 0, last[1]), vy))
+        return xs, ys
+
+    xs = []
+    ys = []
+    (i, j) = (0, 0)
+    (lx, ly) = last
+    while i < len(vx) or j < len(vy):
+        if j == len(vy) or (i < len(vx) and tx[i] <= ty[j]):
+            lx = vx[i]
+            i += 1
+        else:
+            ly = vy[j]
+            j += 1
+        xs.append(lx)
+        ys.append(ly)
+    return xs, ys
+
+
+def _sector(x, y):
+    # angular sector of positions relative to the center
+    if np is not None and isinstance(x, np.ndarray):
+        return ((np.arctan2(y, x) + math.pi) * (GATE_SECTORS / (2 * math.pi))).astype(np.intp) % GATE_SECTORS
+    return int((math.atan2(y, x) + math.pi) * (GATE_SECTORS / (2 * math.pi))) % GATE_SECTORS
+
+
+def gate_update(reach, xs, ys, center, floor):
+    # keeps in reach the furthest distance to the center reached in
+    # each angular sector, returns the positions (relative to the center)
+    # further than floor, which may be on the gate
+    if np is not None and len(xs) >= VECTORIZE_MIN:
+        x = np.asarray(xs, dtype=np.float64) - center[0]
+        y = np.asarray(ys, dtype=np.float64) - center[1]
+        distance = np.hypot(x, y)
+        np.maximum.at(np.frombuffer(reach, dtype=np.float64), _sector(x, y), distance)
+        far = distance >= floor
+        return x[far], y[far]
+
+    far_x = []
+    far_y = []
+    for (x, y) in zip(xs, ys):
+        x -= center[0]
+        y -= center[1]
+        sector = _sector(x, y)
+        distance = math.hypot(x, y)
+        if distance > reach[sector]:
+            reach[sector] = distance
+        if distance >= floor:
+            far_x.append(x)
+            far_y.append(y)
+    return far_x, far_y
+
+
+def gate_rim(reach, xs, ys):
+    # positions on the gate: close to the final reach of their sector.
+    # The reach only settles once the sweep is over, before that the
+    # first push outward would be taken for the gate.
+    if np is not None and len(xs) >= VECTORIZE_MIN:
+        x = np.frombuffer(xs, dtype=np.float64)
+        y = np.frombuffer(ys, dtype=np.float64)
+        r = np.frombuffer(reach, dtype=np.float64)
+        rim = 100 * np.hypot(x, y) >= FIT_RIM_PERCENT * r[_sector(x, y)]
+        return x[rim], y[rim]
+
+    rim = [(x, y) for (x, y) in zip(xs, ys)
+        if 100 * math.hypot(x, y) >= FIT_RIM_PERCENT * reach[_sector(x, y)]]
+    return [x for (x, _) in rim], [y for (_, y) in rim]
+
+
+def fit_accumulate(normal, rhs, xs, ys, scale):
+    # adds the points to the normal equations of the least squares fit
+    # of A x^2 + B xy + C y^2 + D x + E y = 1, coordinates divided by
+    # scale to keep the sums well conditioned
+    if np is not None and len(xs) >= VECTORIZE_MIN:
+        x = np.asarray(xs, dtype=np.float64) / scale
+        y = np.asarray(ys, dtype=np.float64) / scale
+        rows = np.column_stack((x * x, x * y, y * y, x, y))
+        np.frombuffer(normal, dtype=np.float64).reshape(FIT_TERMS, FIT_TERMS)[:] += rows.T @ rows
+        np.frombuffer(rhs, dtype=np.float64)[:] += rows.sum(axis=0)
+        return
+
+    for (x, y) in zip(xs, ys):
+        x /= scale
+        y /= scale
+        row = (x * x, x * y, y * y, x, y)
+        for i in range(FIT_TERMS):
+            rhs[i] += row[i]
+            for j in range(FIT_TERMS):
+                normal[i * FIT_TERMS + j] += row[i] * row[j]
+
+
+def solve(normal, rhs):
+    # solution of the linear system, None when it's singular
+    n = len(rhs)
+    if np is not None:
+        try:
+            return [float(v) for v in np.linalg.solve(np.frombuffer(normal, dtype=np.float64).reshape(n, n),
+                np.frombuffer(rhs, dtype=np.float64))]
+        except np.linalg.LinAlgError:
+            return None
+
+    # Gauss elimination with partial pivoting
+    m = [[normal[i * n + j] for j in range(n)] + [rhs[i]] for i in range(n)]
+    for col in range(n):
+        pivot = max(range(col, n), key=lambda row: abs(m[row][col]))
+        if abs(m[pivot][col]) < 1e-12:
+            return None
+        m[col], m[pivot] = m[pivot], m[col]
+        for row in range(col + 1, n):
+            factor = m[row][col] / m[col][col]
+            for j in range(col, n + 1):
+                m[row][j] -= factor * m[col][j]
+    solution = [0.0] * n
+    for row in range(n - 1, -1, -1):
+        solution[row] = (m[row][n] - sum(m[row][j] * solution[j] for j in range(row + 1, n))) / m[row][row]
+    return solution
+
+
+def ellipse_fit(normal, rhs):
+    # center, half extents along x and y, coupling of the axes (-1 to 1),
+    # tilt (deg) and ratio of the minor to the major axis of the fitted
+    # ellipse, None when the points don't draw an ellipse
+    solution = solve(normal, rhs)
+    if solution is None:
+        return None
+    (a, b, c, d, e) = solution
+    det = a * c - b * b / 4
+    if det <= 0 or a <= 0:
+        return None
+    # center: gradient of the conic is null
+    x0 = (b * e - 2 * c * d) / (4 * det)
+    y0 = (b * d - 2 * a * e) / (4 * det)
+    k = 1 + a * x0 * x0 + b * x0 * y0 + c * y0 * y0
+    if k <= 0:
+        return None
+    # shape of the ellipse as a covariance: inverse of the quadratic form
+    sxx = k * c / det
+    syy = k * a / det
+    sxy = -k * b / (2 * det)
+    coupling = sxy / math.sqrt(sxx * syy)
+    tilt = math.degrees(math.atan2(2 * sxy, sxx - syy) / 2)
+    spread = math.hypot((sxx - syy) / 2, sxy)
+    ratio = math.sqrt(((sxx + syy) / 2 - spread) / ((sxx + syy) / 2 + spread))
+    return x0, y0, math.sqrt(sxx), math.sqrt(syy), coupling, tilt, ratio
+
+
+def sector_angle(sector):
+    # angle (rad) of the middle of a sector
+    return (sector + 0.5) * 2 * math.pi / GATE_SECTORS - math.pi
+
+
+def gate_points(reach):
+    # (x, y) of the gate, relative to the center, None for the sectors
+    # never reached
+    return [(r * math.cos(sector_angle(sector)), r * math.sin(sector_angle(sector))) if r > 0 else None
+        for sector, r in enumerate(reach)]
+
+
+def _median(ordered):
+    n = len(ordered)
+    if n % 2:
+        return ordered[n // 2]
+    return (ordered[n // 2 - 1] + ordered[n // 2]) / 2
+
+
+def robust_stats(values):
+    # median and median absolute deviation of the samples
+    if np is not None and len(values) >= VECTORIZE_MIN:
+        v = np.frombuffer(values, dtype=np.int32)
+        m = np.median(v)
+        return float(m), float(np.median(np.abs(v - m)))
+    m = _median(sorted(values))
+    return m, _median(sorted(abs(v - m) for v in values))
+
+
+def reject_outliers(values, m, mad):
+    # samples within OUTLIER_MAD deviations of the median m
+    limit = OUTLIER_MAD * MAD_SIGMA * mad
+    if np is not None and len(values) >= VECTORIZE_MIN:
+        v = np.frombuffer(values, dtype=np.int32)
+        return array('i', v[np.abs(v - m) <= limit].tobytes())
+    return array('i', [v for v in values if abs(v - m) <= limit])
+
+
+def window_error(values, mad):
+    # half width of the confidence interval of the median of a window
+    return CONFIDENCE_Z * MAD_SIGMA * mad / math.sqrt(len(values))
+
+
+def repetition_error(marks):
+    # half width of the confidence interval of the mean of the
+    # repetitions, 0 until there are two of them
+    if len(marks) < 2:
+        return 0.0
+    mean = sum(marks) / len(marks)
+    variance = sum((x - mean) ** 2 for x in marks) / (len(marks) - 1)
+    return CONFIDENCE_Z * math.sqrt(variance / len(marks))
+
+
+def robust_estimate(values):
+    # trimmed mean of the samples, half width of its confidence interval
+    # and number of samples used. values are already free of outliers.
+    if np is not None and len(values) >= VECTORIZE_MIN:
+        v = np.sort(np.frombuffer(values, dtype=np.int32))
+        cut = len(v) * TRIM_PERCENT // 100
+        v = v[cut:len(v) - cut]
+        return float(v.mean()), float(CONFIDENCE_Z * v.std(ddof=1) / math.sqrt(len(v))), len(v)
+
+    v = sorted(values)
+    cut = len(v) * TRIM_PERCENT // 100
+    v = v[cut:len(v) - cut]
+    mean = sum(v) / len(v)
+    if len(v) < 2:
+        return mean, 0.0, len(v)
+    variance = sum((x - mean) ** 2 for x in v) / (len(v) - 1)
+    return mean, CONFIDENCE_Z * math.sqrt(variance / len(v)), len(v)
+
+
+def stick_parameters(prefix, estimates, calibration):
+    # estimates: (value, half width, samples) of rest -, hold -, rest +, hold +
+    # returns the parameters and the half width of their confidence interval
+    data = [value for (value, *_) in estimates]
+    error = [width for (_, width, _) in estimates]
+    if data[3] == getattr(calibration, f"{prefix}_max") \
+        and data[2] == 0 \
+        and data[1] == getattr(calibration, f"{prefix}_min") \
+        and data[0] == 0:
+        # nothing to do it's perfect !
+        return {}, {}
+
+    axis_center = (data[2] + data[0]) / 2
+    data = [value - axis_center for value in data]          # recenter
+    center_error = math.hypot(error[0], error[2]) / 2
+
+    axis_max = AXIS_MAX_PERCENT * min(abs(data[1]), data[3]) / 100
+    max_error = AXIS_MAX_PERCENT * math.hypot(error[1] if abs(data[1]) < data[3] else error[3], center_error) / 100
+    deadzone = AXIS_DEADZONE_PERCENT * (abs(data[0]) + abs(data[2])) / 200
+    deadzone_error = AXIS_DEADZONE_PERCENT * math.hypot(error[0], error[2]) / 200
+    if (100 * deadzone / axis_max) < AXIS_DEADZONE_PERCENT_MINI:
+        deadzone = AXIS_DEADZONE_PERCENT_MINI * axis_max / 100
+        deadzone_error = AXIS_DEADZONE_PERCENT_MINI * max_error / 100
+
+    parameters = {f"{prefix}_max": int(axis_max),
+        f"{prefix}_min": -int(axis_max),
+        f"{prefix}_center": -int(axis_center),
+        f"{prefix}_deadzone": int(deadzone),
+        f"{prefix}_antideadzone": int(AXIS_ANTIDEADZONE_PERCENT * int(deadzone) / 100)}  # -20 %
+    return parameters, {"center": center_error, "max": max_error, "deadzone": deadzone_error}
+
+
+def trigger_parameters(prefix, estimates, calibration):
+    # estimates of rest and hold in estimates[2] and estimates[3]
+    (rest, rest_error, _) = estimates[2]
+    (hold, hold_error, _) = estimates[3]
+    if hold == getattr(calibration, f"{prefix}_max") and rest == 0:
+        # nothing to do it's perfect !
+        return {}, {}
+
+    # if we change max value, the minimum value is lowered
+    # see kernel driver code for trigger:
+    #
+    # 	value = (int16_t)(trigger_left_max - (data->data[2] | (data->data[3] << 8)));
+    #	input_report_abs(indev, ABS_HAT2X,
+    #       ( value < trigger_left_deadzone )? 0 : value - trigger_left_antideadzone);
+    #
+    maxvalue = TRIGGER_MAX_PERCENT * (hold - rest) / 100
+    deadzone = (TRIGGER_DEADZONE_PERCENT - 100) * rest / 100
+    #                                      ^ we remove 100 because rest
+    #                                        is substracted in maxvalue
+    parameters = {f"{prefix}_max": int(maxvalue),
+        f"{prefix}_deadzone": int(deadzone),
+        f"{prefix}_antideadzone": int(TRIGGER_ANTIDEADZONE_PERCENT * deadzone / 100)}
+    return parameters, {"max": TRIGGER_MAX_PERCENT * math.hypot(hold_error, rest_error) / 100,
+        "deadzone": (TRIGGER_DEADZONE_PERCENT - 100) * rest_error / 100}
+
+
+RESULTS={STICK: stick_parameters, TRIGGER: trigger_parameters}
+
+
+class ControlState:
+    # Progress of the calibration of one control. update() only looks
+    # at the current step, its cost doesn't depend on the number of steps
+    # or of controls in the table.
+    def __init__(self, control, adaptive=CALIBRATE_ADAPTIVE):
+        (self.name, self.short, self.kind, self.group, axes) = control
+        self.codes = tuple(code for (code, *_) in axes)
+        self.labels = tuple(label for (_, _, label, _) in axes)
+        self.steps = control_steps(self.kind, axes)
+        self.adaptive = adaptive
+        self.step = 0
+        self.repetition = 0
+        self.phase = HOLD
+        self.done = False
+        # samples of the last CALIBRATION_DETECTION_TIME of the current axis
+        self.window_times = array('d')
+        self.window = array('i')
+        self.phase_start = None
+        self.extreme = None     # furthest steady position of a first push or rest
+        # samples kept for each position of the current axis and median
+        # of each repetition: rest -, hold -, rest +, hold +
+        self.samples = [array('i') for _ in range(4)]
+        self.marks = [[] for _ in range(4)]
+        self.uncertainty = {}   # label: {parameter: half width}
+        # raw center and reach of each axis from its directions
+        self.centers = [0.0] * len(axes)
+        self.reaches = [0.0] * len(axes)
+        self.prefixes = tuple(prefix for (_, prefix, *_) in axes)
+        self.reach = None       # reach by sector once the sweep is started
+        self.last = [0, 0]      # stick position during the sweep
+        self.gate_samples = 0
+        self.gate = None        # (circularity %, min reach, angle of the min (deg), max reach)
+        # positions of the sweep which may be on the gate, relative to
+        # the center, and result of the ellipse fit of the gate:
+        # (center, half extents, coupling, tilt (deg), minor / major ratio)
+        self.gate_x = array('d')
+        self.gate_y = array('d')
+        self.fit = None
+        self.rests = [(0.0, 0.0)] * len(axes)
+        # (label, direction, position, repetition, samples, time) of each
+        # position taken, (label, direction, "done", repetitions,
+        # samples, uncertainty) of each direction, then the estimates of
+        # each axis and the gate and ellipse of a stick. Reported by the
+        # caller, see CalibrationSession.log().
+        self.log = []
+
+    @property
+    def code(self):
+        # axis being calibrated, None during the sweep
+        return self.steps[self.step][1]
+
+    def active_codes(self):
+        if self.code is None:
+            return self.codes
+        return (self.code,)
+
+    def start(self, axes, calibration):
+        # raw values are measured with the default calibration
+        axes.reset(self.codes)
+        calibration.reset(self.group)
+
+    def update(self, axes, timestamps, values, now, calibration):
+        # True when the control moves to the next step or repetition.
+        # timestamps and values are the new samples of the axis being
+        # calibrated.
+        if self.done:
+            return False
+
+        (axis, code, prefix, sign, short, _) = self.steps[self.step]
+        if self.phase_start is None:
+            self.phase_start = now
+        # an axis which doesn't move keeps its value for the whole frame
+        if len(values):
+            self.window_times.extend(timestamps)
+            self.window.extend(values)
+        else:
+            self.window_times.append(now)
+            self.window.append(axes.value[code])
+        start = bisect.bisect_left(self.window_times, now - CALIBRATION_DETECTION_TIME)
+        if start:
+            del self.window_times[:start]
+            del self.window[:start]
+        elapsed = now - self.phase_start
+        if elapsed < (CALIBRATION_MIN_TIME if self.adaptive else CALIBRATION_DETECTION_TIME):
+            return False
+
+        (m, mad) = robust_stats(self.window)
+        hold = 3 if sign > 0 else 1
+        slot = hold if self.phase == HOLD else hold - 1
+        repetition = self.repetition
+        if self.phase == HOLD:
+            if repetition == 0:
+                # first push: past half of the current range and close
+                # to the furthest position seen so far
+                limit = getattr(calibration, f"{prefix}_max" if sign > 0 else f"{prefix}_min")
+                if sign * m <= sign * limit / 2:
+                    return False
+                if self.extreme is None or sign * m > sign * self.extreme:
+                    self.extreme = m
+                reference = self.extreme
+            else:
+                reference = sum(self.marks[hold]) / repetition
+            scale = reference
+        else:
+            scale = sum(self.marks[hold]) / (repetition + 1)
+            if repetition > 0:
+                reference = sum(self.marks[slot]) / repetition
+            elif self.kind == TRIGGER:
+                # a trigger doesn't rest at 0: the lowest position once
+                # it's released
+                if m >= scale / 2:
+                    return False
+                if self.extreme is None or m < self.extreme:
+                    self.extreme = m
+                reference = self.extreme
+            else:
+                reference = 0
+
+        # the median of the window is not moved by a few wrong samples,
+        # their spread tells whether the position is held
+        if abs(100 * MAD_SIGMA * mad / scale) >= CALIBRATE_STABLE_PERCENT \
+            or abs(100 * (m - reference) / scale) >= CALIBRATE_DETECTION_PERCENT:
+            return False
+        # a short hold is enough once its median is known well enough
+        if elapsed < CALIBRATION_DETECTION_TIME \
+            and abs(100 * window_error(self.window, mad) / scale) > CALIBRATE_TOLERANCE_PERCENT:
+            return False
+
+        self.log.append((self.labels[axis], short, "hold" if self.phase == HOLD else "rest",
+            repetition + 1, len(self.window), round(elapsed, 3)))
+        self.samples[slot].extend(reject_outliers(self.window, m, mad))
+        self.marks[slot].append(m)
+        self.window_times = array('d')
+        self.window = array('i')
+        self.phase_start = now
+        self.extreme = None
+        if self.phase == HOLD:
+            self.phase = REST
+            return False
+
+        self.phase = HOLD
+        self.repetition += 1
+        if not self.direction_done(hold, scale):
+            return True
+
+        self.log.append((self.labels[axis], short, "done", self.repetition,
+            len(self.samples[hold]) + len(self.samples[hold - 1]), round(self.direction_error(hold), 2)))
+        self.repetition = 0
+        self.step += 1
+        if self.step == len(self.steps) or self.steps[self.step][0] != axis:
+            self.finish_axis(axis, prefix, calibration)
+        if self.step == len(self.steps):
+            self.done = True
+            self.step -= 1
+        return True
+
+    def update_gate(self, axes, split, now, calibration):
+        # True once the stick has been around its whole gate
+        if self.done:
+            return False
+
+        if self.reach is None:
+            self.reach = array('d', [0.0]) * GATE_SECTORS
+            self.phase_start = now
+            self.last = [axes.value[self.codes[0]], axes.value[self.codes[1]]]
+        (x, y) = (split[self.codes[0]], split[self.codes[1]])
+        (xs, ys) = pair_samples(x, y, self.last)
+        if len(xs):
+            self.last = [x[1][-1] if len(x[1]) else self.last[0],
+                         y[1][-1] if len(y[1]) else self.last[1]]
+        else:
+            # a stick which doesn't move keeps its position for the whole frame
+            (xs, ys) = ([self.last[0]], [self.last[1]])
+        swept = GATE_COVERAGE_PERCENT * min(self.reaches) / 100
+        (far_x, far_y) = gate_update(self.reach, xs, ys, self.centers, swept)
+        self.gate_x.extend(far_x)
+        self.gate_y.extend(far_y)
+        self.gate_samples += len(xs)
+
+        if now - self.phase_start < GATE_TIME or min(self.reach) < swept:
+            return False
+
+        self.log.append((self.short, GATE, "done", GATE_SECTORS, self.gate_samples, round(now - self.phase_start, 3)))
+        self.finish_gate(calibration)
+        self.done = True
+        return True
+
+    def finish_gate(self, calibration):
+        # the smallest reach sets the range of both axes so that the
+        # stick gets its full range in every direction, diagonals too
+        reach = list(self.reach)
+        low = min(reach)
+        sector = reach.index(low)
+        self.gate = (100 * low / max(reach), low, math.degrees(sector_angle(sector)), max(reach))
+        self.log.append((self.short, GATE, "reach", [int(r) for r in reach]))
+        self.log.append((self.short, GATE, "circularity %.1f %%, reach %d at %d deg to %d" % self.gate))
+
+        normal = array('d', [0.0]) * (FIT_TERMS * FIT_TERMS)
+        rhs = array('d', [0.0]) * FIT_TERMS
+        (rim_x, rim_y) = gate_rim(self.reach, self.gate_x, self.gate_y)
+        fit_accumulate(normal, rhs, rim_x, rim_y, min(self.reaches))
+        fit = ellipse_fit(normal, rhs)
+        if fit is None:
+            self.log.append((self.short, GATE, "no ellipse fits the gate"))
+            axis_max = int(AXIS_MAX_PERCENT * low / 100)
+            for prefix in self.prefixes:
+                calibration.stage(**{f"{prefix}_max": axis_max, f"{prefix}_min": -axis_max})
+            return
+
+        # back to raw values
+        (x0, y0, ex, ey, coupling, tilt, ratio) = fit
+        scale = min(self.reaches)
+        center = (self.centers[0] + x0 * scale, self.centers[1] + y0 * scale)
+        extents = (ex * scale, ey * scale)
+        self.fit = (center, extents, coupling, tilt, ratio)
+        self.log.append((self.short, GATE, "ellipse center (%.1f, %.1f) extents (%.1f, %.1f) coupling %.3f tilt %.1f deg ratio %.3f"
+            % (*center, *extents, coupling, tilt, ratio)))
+
+        # each axis is scaled on its own by the driver: coupled axes get
+        # a smaller range, and the gate must reach it in every direction
+        # once scaled like the ellipse
+        share = math.sqrt(1 - abs(coupling))
+        for point in gate_points(reach):
+            if point is not None:
+                share = min(share, math.hypot((point[0] + self.centers[0] - center[0]) / extents[0],
+                    (point[1] + self.centers[1] - center[1]) / extents[1]))
+
+        for axis, prefix in enumerate(self.prefixes):
+            axis_max = AXIS_MAX_PERCENT * extents[axis] * share / 100
+            (rest_low, rest_high) = self.rests[axis]
+            deadzone = AXIS_DEADZONE_PERCENT * (abs(rest_low - center[axis]) + abs(rest_high - center[axis])) / 200
+            if (100 * deadzone / axis_max) < AXIS_DEADZONE_PERCENT_MINI:
+                deadzone = AXIS_DEADZONE_PERCENT_MINI * axis_max / 100
+            calibration.stage(**{f"{prefix}_max": int(axis_max),
+                f"{prefix}_min": -int(axis_max),
+                f"{prefix}_center": -int(center[axis]),
+                f"{prefix}_deadzone": int(deadzone),
+                f"{prefix}_antideadzone": int(AXIS_ANTIDEADZONE_PERCENT * int(deadzone) / 100)})
+
+    def direction_error(self, hold):
+        # largest half width of the confidence interval of the hold and
+        # rest positions of a direction: noise of the samples or spread
+        # of the repetitions
+        error = 0.0
+        for slot in (hold - 1, hold):
+            error = max(error, robust_estimate(self.samples[slot])[1], repetition_error(self.marks[slot]))
+        return error
+
+    def direction_done(self, hold, scale):
+        if not self.adaptive:
+            return self.repetition >= CALIBRATE_REPEAT
+        if self.repetition < CALIBRATE_MIN_REPEAT:
+            return False
+        if self.repetition >= CALIBRATE_MAX_REPEAT:
+            return True
+        # more repetitions only when the results are not accurate enough
+        return abs(100 * self.direction_error(hold) / scale) <= CALIBRATE_TOLERANCE_PERCENT
+
+    def finish_axis(self, axis, prefix, calibration):
+        estimates = [robust_estimate(samples) if len(samples) else None for samples in self.samples]
+        self.log.append((self.labels[axis], prefix, "estimates", estimates))
+        if self.kind == STICK:
+            self.centers[axis] = (estimates[0][0] + estimates[2][0]) / 2
+            self.rests[axis] = (estimates[0][0], estimates[2][0])
+            self.reaches[axis] = min(self.centers[axis] - estimates[1][0], estimates[3][0] - self.centers[axis])
+        (parameters, uncertainty) = RESULTS[self.kind](prefix, estimates, calibration)
+        calibration.stage(**parameters)
+        self.uncertainty[self.labels[axis]] = uncertainty
+        self.samples = [array('i') for _ in range(4)]
+        self.marks = [[] for _ in range(4)]
+
+    def text(self):
+        (*_, short, text) = self.steps[self.step]
+        return short, text, self.step + 1, len(self.steps), self.repetition + 1
+
+
+class CalibrationSession:
+    # Several controls calibrated at the same time, each one at its own
+    # pace. The results are staged, the caller commits them once done.
+    def __init__(self, names, adaptive=CALIBRATE_ADAPTIVE):
+        self.controls = [ControlState(CONTROL_INDEX[name], adaptive) for name in names]
+
+    def start(self, axes, calibration):
+        for control in self.controls:
+            control.start(axes, calibration)
+
+    def update(self, axes, samples, now, calibration):
+        # True when a control moved to its next step, samples are the
+        # (timestamps, codes, values) read since the last update
+        split = split_samples(samples, self.codes())
+        changed = False
+        for control in self.controls:
+            if control.done:
+                continue
+            if control.code is None:
+                if control.update_gate(axes, split, now, calibration):
+                    changed = True
+                continue
+            (timestamps, values) = split[control.code]
+            if control.update(axes, timestamps, values, now, calibration):
+                changed = True
+        return changed
+
+    @property
+    def done(self):
+        return all(control.done for control in self.controls)
+
+    def codes(self):
+        # axes still calibrated, the other ones are masked
+        return [code for control in self.controls if not control.done for code in control.active_codes()]
+
+    def uncertainty(self):
+        # {label: {parameter: half width of the 95 % confidence interval}}
+        uncertainty = {}
+        for control in self.controls:
+            uncertainty.update(control.uncertainty)
+        return uncertainty
+
+    def log(self):
+        # decisions of every control, see ControlState.log
+        return [(control.name, *entry) for control in self.controls for entry in control.log]
+
+    def gates(self):
+        # {control name: gate reach by sector} of the sticks being swept or done
+        return {control.name: control.reach for control in self.controls if control.reach is not None}
+
+    def worst_uncertainty(self):
+        # (half width, label, parameter) of the least accurate result
+        worst = (0.0, None, None)
+        for label, parameters in self.uncertainty().items():
+            for name, width in parameters.items():
+                if width > worst[0]:
+                    worst = (width, label, name)
+        return worst
+
+    def text(self):
+        if len(self.controls) == 1:
+            control = self.controls[0]
+            (short, text, step, steps, push) = control.text()
+            if short == GATE:
+                return f"Step {step}/{steps}: Rotate stick slowly {text}, twice or more"
+            return f"Step {step}/{steps}, push {push}: Push {control.kind} {text} few seconds and release"
+        steps = []
+        for control in self.controls:
+            (short, _, step, count, push) = control.text()
+            if control.done:
+                steps.append(f"{control.short} done")
+            elif short == GATE:
+                steps.append(f"{control.short} rotate {step}/{count}")
+            else:
+                steps.append(f"{control.short} {short} {step}/{count}#{push}")
+        return "Push few seconds and release:\n" + ", ".join(steps)
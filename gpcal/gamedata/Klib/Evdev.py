@@ -0,0 +1,625 @@
+"""
+    Evdev: a minimal Linux evdev reader
+    Author: Kdog
+    Version: 0.1
+    SPDX-License-Identifier: MIT
+"""
+import ctypes
+import errno
+import fcntl
+import io
+import os
+from pathlib import Path
+import selectors
+import struct
+import threading
+import time
+from array import array
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# struct input_event: tv_sec, tv_usec, type, code, value
+EVENT_FORMAT='llHHi'
+EVENT_SIZE=struct.calcsize(EVENT_FORMAT)
+# Number of events fetched with a single read() syscall. The evdev
+# client buffer of the gamepad is smaller than this so a whole
+# backlog is usually drained in one call.
+EVENT_BATCH=256
+
+# Batches smaller than this are cheaper to apply in plain Python
+# than with NumPy
+VECTORIZE_MIN=256
+
+# Period (s) of the device lookup while the gamepad is missing, inotify
+# on the device directory usually triggers it sooner
+RESCAN_PERIOD=1.0
+
+# Number of samples kept by the input ring buffer, about 10 s of
+# stick motion at the gamepad packet rate
+RING_SIZE=8192
+
+EV_SYN=0
+EV_KEY=1
+EV_ABS=3
+EV_CNT=0x20
+
+SYN_REPORT=0
+SYN_DROPPED=3
+
+ABS_X=0x00
+ABS_Y=0x01
+ABS_Z=0x02
+ABS_RX=0x03
+ABS_RY=0x04
+ABS_RZ=0x05
+ABS_HAT2X=0x14
+ABS_HAT2Y=0x15
+ABS_CNT=0x40
+
+# struct input_absinfo: value, minimum, maximum, fuzz, flat, resolution
+ABSINFO_FORMAT='iiiiii'
+ABSINFO_SIZE=struct.calcsize(ABSINFO_FORMAT)
+
+# ioctl request numbers, see include/uapi/linux/input.h
+_IOC_WRITE=1
+_IOC_READ=2
+
+def _ioc(dir, nr, size):
+    return (dir << 30) | (size << 16) | (ord('E') << 8) | nr
+
+# struct input_id: bustype, vendor, product, version
+INPUT_ID_FORMAT='HHHH'
+EVIOCGID=_ioc(_IOC_READ, 0x02, struct.calcsize(INPUT_ID_FORMAT))
+
+def eviocgname(size):
+    return _ioc(_IOC_READ, 0x06, size)
+
+def eviocgbit(ev, size):
+    return _ioc(_IOC_READ, 0x20 + ev, size)
+
+def eviocgabs(code):
+    return _ioc(_IOC_READ, 0x40 + code, ABSINFO_SIZE)
+
+# select the clock of the event timestamps (CLOCK_REALTIME by default)
+EVIOCSCLOCKID=_ioc(_IOC_WRITE, 0xa0, struct.calcsize('i'))
+
+# struct input_mask: type, codes_size, codes_ptr
+INPUT_MASK_FORMAT='IIQ'
+EVIOCSMASK=_ioc(_IOC_WRITE, 0x93, struct.calcsize(INPUT_MASK_FORMAT))
+
+def test_bit(bits, n):
+    return bits[n // 8] & (1 << (n % 8))
+
+def make_bits(numbers, count):
+    # bitmap in the unsigned long layout expected by the kernel
+    bits = bytearray(((count + 63) // 64) * 8)
+    for n in numbers:
+        bits[n // 8] |= 1 << (n % 8)
+    return bits
+
+# inotify(7), not wrapped by the standard library
+IN_MODIFY=0x00000002
+IN_ATTRIB=0x00000004
+IN_CREATE=0x00000100
+IN_NONBLOCK=os.O_NONBLOCK
+IN_CLOEXEC=os.O_CLOEXEC
+INOTIFY_EVENT_FORMAT='iIII'
+INOTIFY_EVENT_SIZE=struct.calcsize(INOTIFY_EVENT_FORMAT)
+
+def inotify_watch(path, mask):
+    # inotify fd watching path, None if inotify can't be used
+    try:
+        libc = ctypes.CDLL(None, use_errno=True)
+        fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+    except (OSError, AttributeError):
+        return None
+    if fd < 0:
+        return None
+    if libc.inotify_add_watch(fd, os.fsencode(path), mask) < 0:
+        os.close(fd)
+        return None
+    return fd
+
+def inotify_read(fd):
+    # drains the pending events, returns the names they carry
+    names = set()
+    try:
+        while True:
+            data = os.read(fd, 4096)
+            if not data:
+                break
+            offset = 0
+            while offset < len(data):
+                (_, _, _, length) = struct.unpack_from(INOTIFY_EVENT_FORMAT, data, offset)
+                offset += INOTIFY_EVENT_SIZE
+                name = data[offset:offset + length].rstrip(b"\0")
+                offset += length
+                if name:
+                    names.add(os.fsdecode(name))
+    except BlockingIOError:
+        pass
+    return names
+
+def device_info(path):
+    # name and input id of an event node, None if it can't be queried
+    try:
+        fd = os.open(path, os.O_RDONLY | os.O_NONBLOCK)
+    except OSError:
+        return None
+    try:
+        name = bytearray(256)
+        size = fcntl.ioctl(fd, eviocgname(len(name)), name)
+        input_id = bytearray(struct.calcsize(INPUT_ID_FORMAT))
+        fcntl.ioctl(fd, EVIOCGID, input_id)
+        return name[:size].rstrip(b"\0").decode(errors="replace"), struct.unpack(INPUT_ID_FORMAT, input_id)
+    except OSError:
+        return None
+    finally:
+        os.close(fd)
+
+def find_device(name, dev_dir="/dev/input", cache_path=None):
+    # Look for the event node of the named device. The last match is
+    # cached with its input id and reused if the node still answers
+    # with the same name and id, otherwise every node is queried.
+    if cache_path is not None:
+        try:
+            with open(cache_path, "r") as cache:
+                path = cache.readline().strip()
+                input_id = tuple(int(n) for n in cache.readline().split())
+            if device_info(path) == (name, input_id):
+                return Path(path)
+        except (OSError, ValueError):
+            pass
+
+    for path in sorted(Path(dev_dir).glob("event*"), key=lambda p: int(p.name[5:] or 0)):
+        info = device_info(path)
+        if info is not None and info[0] == name:
+            if cache_path is not None:
+                try:
+                    Path(cache_path).parent.mkdir(parents=True, exist_ok=True)
+                    with open(cache_path, "w") as cache:
+                        cache.write(f"{path}\n")
+                        cache.write(" ".join(str(n) for n in info[1]) + "\n")
+                except OSError:
+                    pass
+            return path
+    return None
+
+class RateCounter:
+    def __init__(self):
+        self.count = 0
+        self.rate = 0.0
+        self._last_count = 0
+        self._last_time = time.monotonic()
+
+    def add(self, n=1):
+        self.count += n
+
+    def update(self, period=1.0):
+        # refresh the rate at most once per period, cheap enough
+        # to be called every frame
+        now = time.monotonic()
+        elapsed = now - self._last_time
+        if elapsed >= period:
+            self.rate = (self.count - self._last_count) / elapsed
+            self._last_count = self.count
+            self._last_time = now
+        return self.rate
+
+class AxisTable:
+    # State of every ABS axis indexed by code: current value, min and
+    # max seen, and whether the axis moved since the last reset. Axes
+    # which are not touched yet don't track min/max.
+    def __init__(self, axes):
+        self.axes = axes        # (name, code, min start, max start, touched start)
+        self.value = array('i', [0]) * ABS_CNT
+        self.min = array('i', [0]) * ABS_CNT
+        self.max = array('i', [0]) * ABS_CNT
+        self.touched = array('B', [0]) * ABS_CNT
+        self.reset()
+
+    def reset(self, codes=None):
+        for (_, code, min_start, max_start, touched_start) in self.axes:
+            if codes is None or code in codes:
+                self.min[code] = min_start
+                self.max[code] = max_start
+                self.touched[code] = touched_start
+
+    def update(self, codes, values):
+        if np is not None and len(codes) >= VECTORIZE_MIN:
+            self._update_numpy(codes, values)
+            return
+
+        value, vmin, vmax, touched = self.value, self.min, self.max, self.touched
+        for code, v in zip(codes, values):
+            if v != value[code]:
+                touched[code] = 1
+            value[code] = v
+            if touched[code]:
+                if v < vmin[code]:
+                    vmin[code] = v
+                if v > vmax[code]:
+                    vmax[code] = v
+
+    def _update_numpy(self, codes, values):
+        # Same result as the loop above: group the samples by code
+        # keeping their order, find from which sample each axis is
+        # touched and reduce min/max over these samples only
+        value = np.frombuffer(self.value, dtype=np.int32)
+        touched = np.frombuffer(self.touched, dtype=np.uint8)
+
+        order = np.argsort(np.frombuffer(codes, dtype=np.uint16), kind="stable")
+        c = np.frombuffer(codes, dtype=np.uint16)[order].astype(np.intp)
+        v = np.frombuffer(values, dtype=np.int32)[order]
+
+        starts = np.flatnonzero(np.r_[True, c[1:] != c[:-1]])
+        ends = np.r_[starts[1:], len(c)] - 1
+
+        previous = np.empty_like(v)
+        previous[1:] = v[:-1]
+        previous[starts] = value[c[starts]]
+        changed = v != previous
+
+        moved = np.cumsum(changed)
+        moved -= np.repeat(moved[starts] - changed[starts], ends - starts + 1)
+        tracked = (touched[c] != 0) | (moved > 0)
+
+        np.minimum.at(np.frombuffer(self.min, dtype=np.int32), c[tracked], v[tracked])
+        np.maximum.at(np.frombuffer(self.max, dtype=np.int32), c[tracked], v[tracked])
+        touched[c[changed]] = 1
+        value[c[ends]] = v[ends]
+
+# Upper bounds (s) of the latency histogram buckets, the last bucket
+# holds everything above
+LATENCY_BUCKETS=(0.001, 0.002, 0.004, 0.008, 0.016, 0.032)
+
+class LatencyHistogram:
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = array('L', [0]) * (len(buckets) + 1)
+        self.total = 0.0
+        self.max = 0.0
+
+    def add_many(self, latencies):
+        buckets, counts = self.buckets, self.counts
+        for latency in latencies:
+            index = 0
+            while index < len(buckets) and latency >= buckets[index]:
+                index += 1
+            counts[index] += 1
+            self.total += latency
+            if latency > self.max:
+                self.max = latency
+
+    @property
+    def count(self):
+        return sum(self.counts)
+
+    @property
+    def mean(self):
+        return self.total / max(self.count, 1)
+
+    def labels(self):
+        labels = [f"< {bound * 1000:g} ms" for bound in self.buckets]
+        labels.append(f">= {self.buckets[-1] * 1000:g} ms")
+        return labels
+
+class InputRing:
+    def __init__(self, size=RING_SIZE):
+        self.size = size
+        self.timestamps = array('d', [0.0]) * size
+        self.codes = array('H', [0]) * size
+        self.values = array('i', [0]) * size
+        self.count = 0      # number of samples pushed since creation
+        self.lock = threading.Lock()
+
+    def push(self, samples):
+        with self.lock:
+            index = self.count % self.size
+            for (timestamp, code, value) in samples:
+                self.timestamps[index] = timestamp
+                self.codes[index] = code
+                self.values[index] = value
+                index = (index + 1) % self.size
+            self.count += len(samples)
+
+    def snapshot(self, since):
+        # Return the samples pushed after the since count as arrays
+        # (timestamps, codes, values), the new count and how many samples
+        # were overwritten before they could be read
+        with self.lock:
+            count = self.count
+            start = max(since, count - self.size)
+            lost = start - since
+            first = start % self.size
+            last = count % self.size
+            if count - start == 0:
+                sl = [slice(0, 0)]
+            elif first < last:
+                sl = [slice(first, last)]
+            else:
+                sl = [slice(first, self.size), slice(0, last)]
+
+            timestamps = array('d')
+            codes = array('H')
+            values = array('i')
+            for s in sl:
+                timestamps.extend(self.timestamps[s])
+                codes.extend(self.codes[s])
+                values.extend(self.values[s])
+
+        return count, lost, (timestamps, codes, values)
+
+class EvdevReader:
+    def __init__(self, path, batch=EVENT_BATCH):
+        self.path = path
+        self.fd = os.open(path, os.O_RDONLY | os.O_NONBLOCK)
+        # FileIO.readinto returns None instead of raising when the
+        # non blocking fd is empty
+        self.file = io.FileIO(self.fd, "rb", closefd=False)
+        self.buffer = bytearray(EVENT_SIZE * batch)
+        self.view = memoryview(self.buffer)
+        self.mask = None        # ABS codes filtered in Python if EVIOCSMASK fails
+        self.mask_codes = None
+        self.clock = self.set_clock(time.CLOCK_MONOTONIC)
+        self.abs_codes = self.get_abs_codes()
+        self.report = []        # EV_ABS samples of the pending report
+        self.dropping = False   # SYN_DROPPED received, waiting for SYN_REPORT
+        self.drops = 0
+
+    def get_abs_codes(self):
+        bits = bytearray(ABS_CNT // 8)
+        try:
+            fcntl.ioctl(self.fd, eviocgbit(EV_ABS, len(bits)), bits)
+        except OSError:
+            return []
+        return [code for code in range(ABS_CNT) if test_bit(bits, code)]
+
+    def set_clock(self, clock):
+        # Timestamp the events with the given clock so they can be
+        # compared with now(), keep the realtime default if the kernel
+        # refuses
+        try:
+            fcntl.ioctl(self.fd, EVIOCSCLOCKID, struct.pack('i', clock))
+            return clock
+        except OSError:
+            return time.CLOCK_REALTIME
+
+    def now(self):
+        return time.clock_gettime(self.clock)
+
+    def set_mask(self, codes):
+        # Ask evdev to deliver only EV_ABS events of the given codes,
+        # EV_SYN is never filtered. Kernels older than 4.4 don't know
+        # EVIOCSMASK, the filter is then done while assembling reports.
+        # Returns the current state of the codes added to the mask, their
+        # events were dropped until now.
+        added = [] if self.mask_codes is None else \
+                    [code for code in codes if code not in self.mask_codes]
+        try:
+            self._set_mask(0, make_bits([EV_ABS], EV_CNT))
+            self._set_mask(EV_ABS, make_bits(codes, ABS_CNT))
+            self.mask = None
+        except OSError:
+            self.mask = set(codes)
+        self.mask_codes = list(codes)
+        return self.resync(self.now(), added)
+
+    def _set_mask(self, type, bits):
+        codes = ctypes.create_string_buffer(bytes(bits), len(bits))
+        request = struct.pack(INPUT_MASK_FORMAT, type, len(bits), ctypes.addressof(codes))
+        fcntl.ioctl(self.fd, EVIOCSMASK, request)
+
+    def get_absinfo(self, code):
+        absinfo = bytearray(ABSINFO_SIZE)
+        fcntl.ioctl(self.fd, eviocgabs(code), absinfo)
+        return struct.unpack(ABSINFO_FORMAT, absinfo)
+
+    def read_batch(self):
+        # Fill the preallocated buffer with as many events as available
+        # and decode the whole batch at once, without copying the bytes
+        size = self.file.readinto(self.buffer)
+        if size is None:
+            return []
+        if size == 0:
+            raise OSError(errno.ENODEV, "end of file on event node")
+        return list(struct.iter_unpack(EVENT_FORMAT, self.view[:size]))
+
+    def read(self):
+        events = []
+        while True:
+            batch = self.read_batch()
+            events.extend(batch)
+            if len(batch) * EVENT_SIZE < len(self.buffer):
+                break
+        return events
+
+    def assemble(self, events):
+        # Only hand over complete reports: the ABS events are held back
+        # until the SYN_REPORT closing the packet, so a snapshot never
+        # holds X without its Y
+        samples = []
+        for (tv_sec, tv_usec, type, code, value) in events:
+            if type == EV_ABS:
+                if not self.dropping and (self.mask is None or code in self.mask):
+                    self.report.append((tv_sec + tv_usec / 1000000, code, value))
+            elif type == EV_SYN and code == SYN_REPORT:
+                if self.dropping:
+                    # the kernel buffer overflowed, events were lost:
+                    # read back the current state of every axis
+                    self.dropping = False
+                    samples.extend(self.resync(tv_sec + tv_usec / 1000000))
+                else:
+                    samples.extend(self.report)
+                self.report = []
+            elif type == EV_SYN and code == SYN_DROPPED:
+                self.dropping = True
+                self.drops += 1
+                self.report = []
+        return samples
+
+    def get_absinfo_all(self, codes=None):
+        # absinfo (value, min, max, fuzz, flat, resolution) of every
+        # axis, as applied by the driver
+        absinfo = {}
+        for code in self.abs_codes if codes is None else codes:
+            try:
+                absinfo[code] = self.get_absinfo(code)
+            except OSError:
+                pass
+        return absinfo
+
+    def resync(self, timestamp, codes=None):
+        if codes is None:
+            codes = self.mask_codes
+        codes = [code for code in self.abs_codes \
+                    if codes is None or code in codes]
+        return [(timestamp, code, absinfo[0]) \
+                    for code, absinfo in self.get_absinfo_all(codes).items()]
+
+    def close(self):
+        self.view.release()
+        self.file.close()
+        os.close(self.fd)
+
+class EvdevInput:
+    # Owns the input thread: it sleeps in epoll on the event node of
+    # the named device, an inotify watch of the device directory and a
+    # wake pipe. The node is looked up in the background and reopened
+    # when the driver is reloaded, the ring keeps the samples flowing
+    # to the same consumer across reconnections.
+    def __init__(self, name, ring, dev_dir="/dev/input", cache_path=None, codes=None):
+        self.name = name
+        self.ring = ring
+        self.dev_dir = dev_dir
+        self.cache_path = cache_path
+        self.mask_codes = codes
+        self.clock = time.CLOCK_MONOTONIC
+        self.reader = None
+        self.lock = threading.Lock()    # guards self.reader against the UI thread
+        self.thread = None
+        self.wakeups = RateCounter()
+        self.events = RateCounter()
+        self.cpu_ns = RateCounter()     # CPU time spent reading and decoding
+        self.connections = 0
+        self.past_drops = 0
+
+    @property
+    def path(self):
+        reader = self.reader
+        return None if reader is None else reader.path
+
+    @property
+    def drops(self):
+        reader = self.reader
+        return self.past_drops + (0 if reader is None else reader.drops)
+
+    @property
+    def mask(self):
+        reader = self.reader
+        return None if reader is None else reader.mask
+
+    def now(self):
+        return time.clock_gettime(self.clock)
+
+    def set_mask(self, codes):
+        self.mask_codes = list(codes)
+        with self.lock:
+            if self.reader is not None:
+                # the axes newly delivered start from their current state
+                self.ring.push(self.reader.set_mask(codes))
+
+    def get_absinfo_all(self, codes=None):
+        with self.lock:
+            if self.reader is None:
+                return {}
+            return self.reader.get_absinfo_all(codes)
+
+    def start(self):
+        self.wake_r, self.wake_w = os.pipe()
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(self.wake_r, selectors.EVENT_READ)
+        self.inotify = inotify_watch(self.dev_dir, IN_CREATE | IN_ATTRIB)
+        if self.inotify is not None:
+            self.selector.register(self.inotify, selectors.EVENT_READ)
+        self.thread = threading.Thread(target=self._run, name="evdev", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        if self.thread is None:
+            return
+        os.write(self.wake_w, b"\0")
+        self.thread.join()
+        self.thread = None
+        self.disconnect()
+        self.selector.close()
+        if self.inotify is not None:
+            os.close(self.inotify)
+        os.close(self.wake_r)
+        os.close(self.wake_w)
+
+    def connect(self):
+        path = find_device(self.name, self.dev_dir, self.cache_path)
+        if path is None:
+            return
+        try:
+            reader = EvdevReader(path)
+        except OSError:
+            # the node exists but udev didn't set its permissions yet,
+            # the IN_ATTRIB event will trigger a new attempt
+            return
+        self.clock = reader.set_clock(time.CLOCK_MONOTONIC)
+        if self.mask_codes is not None:
+            reader.set_mask(self.mask_codes)
+        with self.lock:
+            self.reader = reader
+        self.selector.register(reader.fd, selectors.EVENT_READ)
+        self.connections += 1
+        # pick up the current state, the last known one is kept until then
+        self.ring.push(reader.resync(self.now()))
+
+    def disconnect(self):
+        if self.reader is None:
+            return
+        self.selector.unregister(self.reader.fd)
+        with self.lock:
+            reader = self.reader
+            self.reader = None
+        self.past_drops += reader.drops
+        reader.close()
+
+    def _run(self):
+        rescan = True
+        while True:
+            if self.reader is None and rescan:
+                rescan = False
+                self.connect()
+            # while disconnected the device directory is also polled, in
+            # case the node came back before the old one was closed
+            timeout = RESCAN_PERIOD if self.reader is None else None
+            ready = [key.fd for key, _ in self.selector.select(timeout)]
+            if self.wake_r in ready:
+                break
+            if self.inotify in ready:
+                inotify_read(self.inotify)
+            if not ready or self.inotify in ready:
+                rescan = True
+            if self.reader is None or self.reader.fd not in ready:
+                continue
+
+            self.wakeups.add()
+            cpu = time.thread_time_ns()
+            try:
+                events = self.reader.read()
+            except OSError:
+                # ENODEV: the driver is gone, wait for the node to come back
+                self.disconnect()
+                continue
+            samples = self.reader.assemble(events)
+            self.events.add(len(events))
+            self.cpu_ns.add(time.thread_time_ns() - cpu)
+            if samples:
+                self.ring.push(samples)
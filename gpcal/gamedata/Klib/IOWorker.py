@@ -0,0 +1,49 @@
+"""
+    IOWorker: file and sysfs I/O out of the render loop
+    Author: Kdog
+    Version: 0.1
+    SPDX-License-Identifier: MIT
+"""
+from concurrent.futures import ThreadPoolExecutor
+
+
+class IOWorker:
+    # A single thread runs the tasks in submission order, so writes of
+    # the driver parameters never overlap
+    def __init__(self):
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="gpcal-io")
+        self.tasks = []     # (text, future) followed by the UI
+        self.done = 0
+        self.failed = 0
+
+    def submit(self, function, *args, text=None, follow=True):
+        # text is shown once the task is done, follow=False for the
+        # periodic tasks the UI doesn't report
+        future = self.executor.submit(function, *args)
+        if follow:
+            self.tasks.append((text, future))
+        return future
+
+    @property
+    def pending(self):
+        return len(self.tasks)
+
+    def poll(self):
+        # (text, future) of the followed tasks finished since the last call
+        finished = []
+        running = []
+        for task in self.tasks:
+            if task[1].done():
+                finished.append(task)
+                if task[1].exception() is None:
+                    self.done += 1
+                else:
+                    self.failed += 1
+            else:
+                running.append(task)
+        self.tasks = running
+        return finished
+
+    def close(self):
+        # waits for the pending writes
+        self.executor.shutdown(wait=True)
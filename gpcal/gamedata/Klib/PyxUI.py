@@ -5,16 +5,42 @@
     SPDX-License-Identifier: MIT
 """
 import pyxel
-import struct
-import os
 from pathlib import Path
 import math
+import os
+from array import array
 
-from Klib.RPocket import RPCalibration
+from Klib.RPocket import RPCalibration, RPHistory, RPProfiles, GAMEPAD_NAME, device_key
+from Klib.IOWorker import IOWorker
+from Klib.Evdev import *
 
-INPUT_SEARCH_PATH="/sys/class/input"
 INPUT_DEV_DIR="/dev/input"
-GAMEPAD_NAME="Retroid Pocket Gamepad"
+INPUT_CACHE_PATH=Path(os.environ.get("XDG_CACHE_HOME", Path.home() / ".cache")) / "gpcal" / "event_path"
+ABSINFO_REFRESH=1.0     # period (s) of the absinfo read back from the driver
+# name, ABS code, min and max start values, touched at start
+# (a trigger only tracks min/max once it has moved)
+GAMEPAD_AXES=(
+    ("leftx", ABS_X, 0, 0, True),
+    ("lefty", ABS_Y, 0, 0, True),
+    ("leftz", ABS_Z, 0, 0, True),
+    ("rightx", ABS_RX, 0, 0, True),
+    ("righty", ABS_RY, 0, 0, True),
+    ("rightz", ABS_RZ, 0, 0, True),
+    ("triggerleft", ABS_HAT2X, 1000, 0, False),
+    ("triggerright", ABS_HAT2Y, 1000, 0, False),
+)
+# ABS codes used by the tool, everything else is filtered by the kernel
+GAMEPAD_CODES=tuple(code for (_, code, *_) in GAMEPAD_AXES)
+# range of an axis from the calibration until the driver is read:
+# ABS code: (max parameter, antideadzone parameter)
+CALIBRATION_RANGES={
+    ABS_X: ("axis_leftx_max", "axis_leftx_antideadzone"),
+    ABS_Y: ("axis_lefty_max", "axis_lefty_antideadzone"),
+    ABS_RX: ("axis_rightx_max", "axis_rightx_antideadzone"),
+    ABS_RY: ("axis_righty_max", "axis_righty_antideadzone"),
+    ABS_HAT2X: ("trigger_left_max", "trigger_left_antideadzone"),
+    ABS_HAT2Y: ("trigger_right_max", "trigger_right_antideadzone"),
+}
 
 class UIObject:
     def __init__(self,x=0,y=0,w=320,h=240):
@@ -233,7 +259,10 @@ class UIStick(UIButton):
         
         self.xdelta = 0
         self.ydelta = 0
+        self.xrange = 1
+        self.yrange = 1
         self.truncate = False
+        self.gate = None    # (x, y) of the measured gate, relative to the center
     
     def update(self):
         super().update()
@@ -241,8 +270,12 @@ class UIStick(UIButton):
     def update_value(self,xvalue,xrange,yvalue,yrange):        
         self.xdelta = math.ceil((self.r * xvalue) / (xrange * 2))
         self.ydelta = math.ceil((self.r * yvalue) / (yrange * 2))
+        self.xrange = xrange
+        self.yrange = yrange
 
-        
+    def set_gate(self, points):
+        # points by angle, None where the gate is unknown
+        self.gate = points
 
     def toggle_truncate(self):
         self.truncate = not self.truncate
@@ -279,6 +312,15 @@ class UIStick(UIButton):
                     self.ydelta = self.ydelta * ratio
 
         pyxel.circb(self.x,self.y,self.r,lcolor)
+        if self.gate:
+            # same scale as the stick position
+            xscale = self.r / (self.xrange * 2)
+            yscale = self.r / (self.yrange * 2)
+            for i, point in enumerate(self.gate):
+                following = self.gate[(i + 1) % len(self.gate)]
+                if point is not None and following is not None:
+                    pyxel.line(self.x + point[0] * xscale, self.y + point[1] * yscale,
+                        self.x + following[0] * xscale, self.y + following[1] * yscale, 13)
         pyxel.circ(self.x + self.xdelta,self.y + self.ydelta,self.r/2,fcolor)
 
 class UIGamepad(UIPanel):
@@ -298,50 +340,57 @@ class UIGamepad(UIPanel):
         self.textbox_info.toggle_visible()
         self.add_uiobject(self.textbox_info)
 
-        self.event_path = None
-        self.find_event_path()
-
-        self.event_format = 'llHHi'
-        self.event_size = struct.calcsize(self.event_format)
-
-        self.eventpipe = os.open(self.event_path, os.O_RDONLY | os.O_NONBLOCK)
+        # the reader thread feeds the ring, update() takes one snapshot
+        # of the new samples per frame
+        self.ring = InputRing()
+        self.ring_count = 0
+        self.samples = ((), (), ())     # timestamps, codes, values
+        self.samples_time = 0.0         # now() when the samples were taken
+        self.samples_lost = 0
+        self.frames = RateCounter()
+        # event timestamp to update() and to draw() of the frame using it
+        self.latency_update = LatencyHistogram()
+        self.latency_draw = LatencyHistogram()
+        self.pending_draw = array('d')
+        # the gamepad node is looked up by the input thread, it may
+        # appear or be reprobed at any time
+        self.input = EvdevInput(GAMEPAD_NAME, self.ring, INPUT_DEV_DIR, INPUT_CACHE_PATH, GAMEPAD_CODES)
+        self.input.start()
+        self.absinfo = {}
+        self.absinfo_connections = 0    # connections of the input when it was read
+        self.refresh_absinfo()
 
         self.calibration = RPCalibration(default_trigger_max=0x755)
-
-        self.leftx = 0
-        self.leftx_min = 0
-        self.leftx_max = 0
-
-        self.lefty = 0
-        self.lefty_min = 0
-        self.lefty_max = 0
-
-        self.rightx = 0
-        self.rightx_min = 0
-        self.rightx_max = 0
-
-        self.righty = 0
-        self.righty_min = 0
-        self.righty_max = 0
-
-        self.triggerright = 0
-        self.triggerright_min = 1000
-        self.triggerright_max = 0
-        self.triggerright_touched = 0
-
-        self.triggerleft = 0
-        self.triggerleft_min = 1000
-        self.triggerleft_max = 0
-        self.triggerleft_touched = 0
-    
-    def find_event_path(self, gp_name=GAMEPAD_NAME):
-        search_path = Path(INPUT_SEARCH_PATH)
-        for sys_event_dir in search_path.glob("event*"):
-            with open(sys_event_dir / "device" / "name", "r") as event_name_file:
-                if event_name_file.readline().strip() == gp_name:
-                    sys_event_dir.stem
-                    self.event_path=Path(INPUT_DEV_DIR) / sys_event_dir.stem
-                    break
+        self.history = RPHistory(self.calibration)
+        self.parameters_changed = []
+        self.profiles = RPProfiles()
+        self.device_key = None
+        self.device_future = None
+        self.device_connections = 0     # connections of the input at the last lookup
+        self.device_profile = None      # profile of the unit, applied once
+        # sysfs and files are only touched by the I/O thread from now on
+        self.io = IOWorker()
+        self.refresh_future = None
+
+        self.axes = AxisTable(GAMEPAD_AXES)
+
+    @property
+    def event_path(self):
+        return self.input.path
+
+    def refresh_absinfo(self):
+        # ranges really applied by the driver, they follow the
+        # calibration once update_params has been processed. The last
+        # known ranges are kept while the gamepad is away.
+        self.absinfo_connections = self.input.connections
+        self.absinfo = self.input.get_absinfo_all(GAMEPAD_CODES) or self.absinfo
+        self.absinfo_time = self.now()
+
+    def axis_range(self, code):
+        if code in self.absinfo:
+            return max(self.absinfo[code][2], 1)
+        (maximum, antideadzone) = CALIBRATION_RANGES[code]
+        return max(getattr(self.calibration, maximum) - getattr(self.calibration, antideadzone), 1)
     
     def reset_measurements_all(self):
         self.reset_measurements_stickleft()
@@ -350,92 +399,168 @@ class UIGamepad(UIPanel):
         self.reset_measurements_triggerright()
 
     def reset_measurements_stickleft(self):
-        self.leftx_max = 0
-        self.leftx_min = 0
-        self.lefty_max = 0
-        self.lefty_min = 0
+        self.axes.reset((ABS_X, ABS_Y, ABS_Z))
 
     def reset_measurements_stickright(self):
-        self.rightx_max = 0
-        self.rightx_min = 0
-        self.righty_max = 0
-        self.righty_min = 0
+        self.axes.reset((ABS_RX, ABS_RY, ABS_RZ))
 
     def reset_measurements_triggerleft(self):
-        self.triggerleft_max = 0
-        self.triggerleft_min = 1000
-        self.triggerleft_touched = False
+        self.axes.reset((ABS_HAT2X,))
 
     def reset_measurements_triggerright(self):
-        self.triggerright_max = 0
-        self.triggerright_min = 1000
-        self.triggerright_touched = False
+        self.axes.reset((ABS_HAT2Y,))
 
     def backup_calibration(self):
-        self.backup_calibration_data = RPCalibration()
+        self.history.push()
 
     def restore_calibration(self):
-        self.backup_calibration_data.apply_parameters()
-        self.calibration=self.backup_calibration_data
-
-    def update(self):
-
-        while True:
-            try:
-                event = os.read(self.eventpipe, self.event_size)
-                #event = b'\x00' * 24
-
-                (tv_sec, tv_usec, type, code, value) = struct.unpack(self.event_format, event)
-
-                if type == 3 and  code == 0:  
-                    self.leftx = value
-                    self.leftx_min = min(self.leftx_min, value)
-                    self.leftx_max = max(self.leftx_max, value)
-
-
-                elif type == 3 and  code == 1:
-                    self.lefty = value
-                    self.lefty_min = min(self.lefty_min, value)
-                    self.lefty_max = max(self.lefty_max, value)
-
-                elif type == 3 and code == 3:
-                    self.rightx = value
-                    self.rightx_min = min(self.rightx_min, value)
-                    self.rightx_max = max(self.rightx_max, value)
-
-                elif type == 3 and code == 4:
-                    self.righty = value
-                    self.righty_min = min(self.righty_min, value)
-                    self.righty_max = max(self.righty_max, value)
-
-                elif type == 3 and  code == 20:
-                    if value != self.triggerleft:
-                        self.triggerleft_touched = True
-                    self.triggerleft = value
+        self.history.cancel()
 
-                    if self.triggerleft_touched:
-                        self.triggerleft_min = min(self.triggerleft_min, value)
-                        self.triggerleft_max = max(self.triggerleft_max, value)
+    def now(self):
+        # current time on the clock of the event timestamps
+        return self.input.now()
 
-                elif type == 3 and code == 21:
-                    if value != self.triggerright:
-                        self.triggerright_touched = True
-                    self.triggerright = value
+    def set_input_mask(self, codes=GAMEPAD_CODES):
+        self.input.set_mask(codes)
 
-                    if self.triggerright_touched:
-                        self.triggerright_min = min(self.triggerright_min, value)
-                        self.triggerright_max = max(self.triggerright_max, value)
-
-            except OSError as e:
-                break
-
-        self.stickleft.update_value(self.leftx,self.calibration.axis_leftx_max-self.calibration.axis_leftx_antideadzone,self.lefty,self.calibration.axis_lefty_max-self.calibration.axis_lefty_antideadzone)
-        self.stickright.update_value(self.rightx,self.calibration.axis_rightx_max-self.calibration.axis_rightx_antideadzone,self.righty,self.calibration.axis_righty_max-self.calibration.axis_righty_antideadzone)
-        self.gauge_triggerleft.update_value(self.triggerleft,self.calibration.trigger_left_max-self.calibration.trigger_left_antideadzone)
-        self.gauge_triggerright.update_value(self.triggerright,self.calibration.trigger_right_max-self.calibration.trigger_right_antideadzone)
+    def update(self):
+        self.frames.add()
+
+        self.ring_count, lost, self.samples = self.ring.snapshot(self.ring_count)
+        self.samples_time = self.now()
+        self.samples_lost += lost
+
+        (timestamps, codes, values) = self.samples
+        self.axes.update(codes, values)
+
+        now = self.now()
+        self.latency_update.add_many([now - t for t in timestamps])
+        self.pending_draw.extend(timestamps)
+
+        # a new device node comes with the ranges of the reloaded driver
+        if self.input.connections != self.absinfo_connections or \
+                self.now() - self.absinfo_time > ABSINFO_REFRESH:
+            self.refresh_absinfo()
+
+        # identity of the unit, its saved profile is applied once it is known
+        self.device_profile = None
+        if self.event_path is not None and self.device_key is None:
+            # a failed lookup is only tried again on the next connection
+            if self.device_future is None:
+                if self.device_connections != self.input.connections:
+                    self.device_connections = self.input.connections
+                    self.device_future = self.io.submit(device_key, self.event_path, follow=False)
+            elif self.device_future.done():
+                self.device_key = self.device_future.result()
+                self.device_future = None
+                if self.device_key is not None:
+                    self.apply_device_profile()
+
+        # parameters written by other programs, looked up by the I/O
+        # thread, one lookup at a time
+        self.parameters_changed = []
+        if self.refresh_future is None or self.refresh_future.done():
+            if self.refresh_future is not None and self.refresh_future.exception() is None:
+                self.parameters_changed = self.calibration.refresh(self.refresh_future.result())
+            self.refresh_future = self.io.submit(self.calibration.sysfs.refresh, follow=False)
+
+        self.stickleft.update_value(self.leftx,self.axis_range(ABS_X),self.lefty,self.axis_range(ABS_Y))
+        self.stickright.update_value(self.rightx,self.axis_range(ABS_RX),self.righty,self.axis_range(ABS_RY))
+        self.gauge_triggerleft.update_value(self.triggerleft,self.axis_range(ABS_HAT2X))
+        self.gauge_triggerright.update_value(self.triggerright,self.axis_range(ABS_HAT2Y))
 
         super().update()
 
+    def record_draw_latency(self):
+        # called once the frame using the samples is drawn, pyxel may
+        # run several updates before a draw when it is late
+        now = self.now()
+        self.latency_draw.add_many([now - t for t in self.pending_draw])
+        self.pending_draw = array('d')
+
+    def latency_text(self):
+        update, draw = self.latency_update, self.latency_draw
+        text = f"{'input latency':<15}|{'update':^8}|{'draw':^8}|\n"
+        for label, nupdate, ndraw in zip(update.labels(), update.counts, draw.counts):
+            text += f"{label:<15}|{100 * nupdate / max(update.count, 1):#7.1f}%|" \
+                + f"{100 * ndraw / max(draw.count, 1):#7.1f}%|\n"
+        text += f"{'mean/max ms':<15}|{1000 * update.mean:#4.1f}/{1000 * update.max:<3.0f}|" \
+            + f"{1000 * draw.mean:#4.1f}/{1000 * draw.max:<3.0f}|\n"
+        return text
+
+    def dump_latency(self, path):
+        with open(path, "w") as dumpfile:
+            dumpfile.write("# GPcal input latency, event timestamp to update() and draw()\n")
+            dumpfile.write("# bucket update draw\n")
+            for label, nupdate, ndraw in zip(self.latency_update.labels(), self.latency_update.counts, self.latency_draw.counts):
+                dumpfile.write(f"{label} {nupdate} {ndraw}\n")
+            dumpfile.write(f"samples {self.latency_update.count} {self.latency_draw.count}\n")
+            dumpfile.write(f"mean_ms {1000 * self.latency_update.mean:.3f} {1000 * self.latency_draw.mean:.3f}\n")
+            dumpfile.write(f"max_ms {1000 * self.latency_update.max:.3f} {1000 * self.latency_draw.max:.3f}\n")
+
+    def absinfo_text(self):
+        text = f"{'driver absinfo':<15}|{'min':^6}|{'max':^6}|{'fuzz':^6}|{'flat':^6}|\n"
+        for (name, code, *_) in GAMEPAD_AXES:
+            if code in self.absinfo:
+                (_, minimum, maximum, fuzz, flat, _) = self.absinfo[code]
+                text += f"{name:<15}|{minimum:#6}|{maximum:#6}|{fuzz:#6}|{flat:#6}|\n"
+        return text
+
+    def stats_text(self):
+        fps = max(self.frames.update(), 1)
+        if self.event_path is None:
+            mask = "n/a"
+        else:
+            mask = "kernel" if self.input.mask is None else "python"
+        sysfs = self.calibration.sysfs
+        if sysfs.ack_last is None:
+            ack = f"{sysfs.ack_timeouts:#3} ack timeouts"
+        else:
+            ack = f"ack {1000 * sysfs.ack_last:.1f}/{1000 * sysfs.ack_max:.1f} ms"
+        return f"{'device':<15}|{str(self.event_path or 'waiting'):>8}|{self.input.connections:#3} connections\n" \
+            + f"{'wakeups/s':<15}|{self.input.wakeups.update():#8.1f}|\n" \
+            + f"{'events/s':<15}|{self.input.events.update():#8.1f}|\n" \
+            + f"{'events/frame':<15}|{self.input.events.rate / fps:#8.1f}|\n" \
+            + f"{'cpu us/frame':<15}|{self.input.cpu_ns.update() / fps / 1000:#8.1f}|\n" \
+            + f"{'event mask':<15}|{mask:>8}|{len(self.input.mask_codes):#3} codes\n" \
+            + f"{'samples lost':<15}|{self.samples_lost:#8}|{self.input.drops:#4} syn dropped\n" \
+            + f"{'sysfs writes':<15}|{sysfs.writes:#8}|{self.calibration.requested:#4} requested, {sysfs.syscalls} io/apply, {ack}\n" \
+            + f"{'io tasks':<15}|{self.io.pending:#8}|{self.io.done:#4} done, {self.io.failed} failed, {sysfs.refresh_syscalls} io/refresh\n"
+
+    def flush_calibration(self):
+        values = self.calibration.take_pending()
+        if values is not None:
+            self.io.submit(self.calibration.write_values, values, self.calibration.committed)
+
+    def apply_device_profile(self):
+        name = self.profiles.find(self.device_key)
+        if name is None:
+            return
+        self.history.push()
+        self.calibration.stage(**self.profiles.get(name))
+        if self.calibration.commit():
+            self.device_profile = name
+        else:
+            self.history.cancel()
+
+    def save_calibration(self, name):
+        # the profile becomes the default one of apply.py and the one of
+        # this unit
+        self.profiles.put(name, self.calibration, device=self.device_key)
+        self.io.submit(self.profiles.write, self.profiles.serialise(),
+                       text=f"Saved as {name} in {self.profiles.path.name}")
+
+    def export_calibration(self, savepath):
+        self.io.submit(self.calibration.save_parameters, savepath, self.calibration.snapshot(),
+                       text=f"Exported to {savepath}")
+
+    def close(self):
+        self.input.stop()
+        # the pending writes are done before leaving
+        self.flush_calibration()
+        self.io.close()
+        self.calibration.close()
+
     def toggle_sdl_view(self):
         self.stickleft.toggle_truncate()
         self.stickright.toggle_truncate()
@@ -449,6 +574,16 @@ class UIGamepad(UIPanel):
         
         super().draw()
 
+def _axis_property(column, code):
+    return property(lambda self: getattr(self.axes, column)[code])
+
+# expose the axis table as leftx, leftx_min, leftx_max, leftx_touched...
+for (name, code, *_) in GAMEPAD_AXES:
+    setattr(UIGamepad, name, _axis_property("value", code))
+    setattr(UIGamepad, f"{name}_min", _axis_property("min", code))
+    setattr(UIGamepad, f"{name}_max", _axis_property("max", code))
+    setattr(UIGamepad, f"{name}_touched", _axis_property("touched", code))
+
 class UITextbox(UIObject):
     def __init__(self, x=0, y=0, w=200, h=50, fcolor=0,lcolor=7,tcolor=7,text="Display test here\nAnotherline",minshowframe=0):
         super().__init__(x, y, w, h)
@@ -5,8 +5,15 @@
     SPDX-License-Identifier: MIT
 """
 
+import json
+import os
 from pathlib import Path
 import sys
+import time
+from array import array
+from collections import deque
+
+from Klib.Evdev import inotify_watch, inotify_read, IN_MODIFY, device_info
 
 # Default value used when calibration is reset
 # DEFAULT_AXIS_MAX : this one is not critical as it only
@@ -22,90 +29,315 @@ DEFAULT_AXIS_MAX=0x580
 # the calibration procedure.
 DEFAULT_TRIGGER_MAX=0x755
 
+# The driver clears update_params on the next packet of the gamepad
+# once the new ranges are set
+ACK_TIMEOUT=0.25
+ACK_POLL=0.001
+
+# Period (s) of the re-read of the parameters when inotify can't
+# tell us about the writes of other programs
+PARAMETER_POLL=2.0
+
+# Name of the input device of the gamepad, see gamepad-name in the
+# device tree
+GAMEPAD_NAME="Retroid Pocket Gamepad"
+# Stable identifiers of the unit, the first one available is used.
+# machine-id is the last resort, it is shared by units flashed from
+# the same image.
+SERIAL_PATHS=("/sys/devices/soc0/serial_number", "/proc/device-tree/serial-number", "/etc/machine-id")
+
+# Calibrations saved by GPcal, applied at boot by apply.py
+PROFILES_PATH=Path.home() / "GPcal-profiles.json"
+PROFILES_VERSION=1
+
+# Number of calibrations kept for undo
+HISTORY_SIZE=16
+
+# Limits of the values accepted for a parameter, the driver does
+# its maths on 16 bits samples
+AXIS_LIMIT=0x7fff
+TRIGGER_LIMIT=0xffff
+
+PARAMETER_AXES=("leftx", "lefty", "leftz", "rightx", "righty", "rightz")
+PARAMETER_TRIGGERS=("left", "right")
+
+# Module parameters of the retroid driver, in sysfs order
+# name, group, default, low, high
+PARAMETERS=[]
+for axis in PARAMETER_AXES:
+    group = "axis_" + axis[:-1]
+    PARAMETERS += [
+        (f"axis_{axis}_antideadzone", group, 0, 0, AXIS_LIMIT),
+        (f"axis_{axis}_center", group, 0, -AXIS_LIMIT, AXIS_LIMIT),
+        (f"axis_{axis}_deadzone", group, 0, 0, AXIS_LIMIT),
+        (f"axis_{axis}_max", group, DEFAULT_AXIS_MAX, 0, AXIS_LIMIT),
+        (f"axis_{axis}_min", group, -DEFAULT_AXIS_MAX, -AXIS_LIMIT, 0),
+    ]
+for trigger in PARAMETER_TRIGGERS:
+    group = "trigger_" + trigger
+    PARAMETERS += [
+        (f"trigger_{trigger}_antideadzone", group, 0, 0, TRIGGER_LIMIT),
+        (f"trigger_{trigger}_deadzone", group, 0, 0, TRIGGER_LIMIT),
+        (f"trigger_{trigger}_max", group, DEFAULT_TRIGGER_MAX, 0, TRIGGER_LIMIT),
+    ]
+# written last, it makes the driver reload the ranges of the axes
+PARAMETERS.append(("update_params", "control", 0, 0, 1))
+
+PARAMETER_NAMES=tuple(row[0] for row in PARAMETERS)
+PARAMETER_INDEX={name: index for index, name in enumerate(PARAMETER_NAMES)}
+PARAMETER_COUNT=len(PARAMETERS)
+UPDATE_PARAMS=PARAMETER_INDEX["update_params"]
+# Newer drivers take every parameter but update_params at once in a
+# single "calibration" record, in the order of PARAMETERS, and set
+# update_params themselves
+BATCH_NAME="calibration"
+BATCH_INDEXES=tuple(index for index in range(PARAMETER_COUNT) if index != UPDATE_PARAMS)
+
+
+class SysfsParameters:
+    # The parameter files of one driver, opened once for the session.
+    # Only the values which differ from the last known state of the
+    # driver are written.
+    def __init__(self, path):
+        self.path = Path(path)
+        self.fds = [None] * PARAMETER_COUNT
+        self.batch_fd = None
+        self.batched = (self.path / BATCH_NAME).exists()
+        # sysfs attributes take each write whole, a copy of the
+        # parameters in a regular directory keeps the end of a longer
+        # previous value unless it is truncated
+        self.regular = Path(os.path.realpath(self.path)).parts[1:2] != ("sys",)
+        self.kernel = None      # last values read from or written to the driver
+        self.syscalls = 0       # syscalls of the last read or write
+        self.refresh_syscalls = 0   # syscalls of every refresh()
+        self.writes = 0
+        self.ack_last = None    # time from the commit to update_params cleared
+        self.ack_max = 0.0
+        self.ack_timeouts = 0
+        # writes from other programs (boot script, shell...) are notified,
+        # the changes made by the driver itself (update_params) are not
+        self.inotify = inotify_watch(self.path, IN_MODIFY)
+        self.poll_time = time.monotonic()
+
+    def fd(self, index):
+        if self.fds[index] is None:
+            self.fds[index] = os.open(self.path / PARAMETER_NAMES[index], os.O_RDWR)
+            self.syscalls += 1
+        return self.fds[index]
+
+    def read(self, index):
+        self.syscalls += 1
+        return int(os.pread(self.fd(index), 32, 0).split(b"\n")[0])
+
+    def batch_file(self):
+        if self.batch_fd is None:
+            self.batch_fd = os.open(self.path / BATCH_NAME, os.O_RDWR)
+            self.syscalls += 1
+        return self.batch_fd
+
+    def read_batch(self):
+        # {index: value} of the calibration record
+        self.syscalls += 1
+        fields = os.pread(self.batch_file(), 4096, 0).split()
+        if len(fields) != len(BATCH_INDEXES):
+            raise ValueError(f"{BATCH_NAME}: {len(fields)} values")
+        return dict(zip(BATCH_INDEXES, (int(field) for field in fields)))
+
+    def read_all(self):
+        self.syscalls = 0
+        values = array('i', [0]) * PARAMETER_COUNT
+        if self.batched:
+            for index, value in self.read_batch().items():
+                values[index] = value
+            values[UPDATE_PARAMS] = self.read(UPDATE_PARAMS)
+        else:
+            for index in range(PARAMETER_COUNT):
+                values[index] = self.read(index)
+        self.kernel = array('i', values)
+        return values
+
+    def cached(self):
+        # the last known values of the driver, read once per session
+        if self.kernel is None:
+            return self.read_all()
+        return array('i', self.kernel)
+
+    def refresh(self, period=PARAMETER_POLL):
+        # {index: value} of the parameters changed by other programs since
+        # the last call. Our own writes are already in the cache, reading
+        # them back after their notification finds nothing new.
+        if self.kernel is None:
+            return {}
+        if self.inotify is not None:
+            names = inotify_read(self.inotify)
+            indexes = [PARAMETER_INDEX[name] for name in names if name in PARAMETER_INDEX]
+        elif time.monotonic() - self.poll_time > period:
+            self.poll_time = time.monotonic()
+            indexes = range(PARAMETER_COUNT)
+        else:
+            return {}
+        # the reads of a refresh are not the ones of the last write
+        syscalls = self.syscalls
+        changed = {}
+        try:
+            if self.batched and (self.inotify is None or BATCH_NAME in names):
+                values = self.read_batch()
+            else:
+                values = {index: self.read(index) for index in indexes if index != UPDATE_PARAMS}
+            for index, value in values.items():
+                if value != self.kernel[index]:
+                    self.kernel[index] = value
+                    changed[index] = value
+        except (OSError, ValueError):
+            pass
+        self.refresh_syscalls += self.syscalls - syscalls
+        self.syscalls = syscalls
+        return changed
+
+    def write(self, values, full=False):
+        # returns the number of values written, update_params excluded
+        self.syscalls = 0
+        if full or self.kernel is None:
+            dirty = [index for index in range(PARAMETER_COUNT) if index != UPDATE_PARAMS]
+        else:
+            dirty = [index for index in range(PARAMETER_COUNT)
+                     if values[index] != self.kernel[index] and index != UPDATE_PARAMS]
+        if not dirty:
+            return 0
+        if self.batched:
+            try:
+                self._write_batch(values)
+                self.writes += len(dirty)
+                return len(dirty)
+            except OSError:
+                # not taken by this driver, back to one file per parameter
+                self.batched = False
+                self.close_files()
+                self.kernel = None
+                dirty = list(BATCH_INDEXES)
+        if self.kernel is not None:
+            dirty = self.safe_order(values, dirty)
+        try:
+            self._write(values, dirty)
+        except OSError:
+            # the files may be gone with a reload of the driver, write
+            # everything again through new descriptors
+            self.close_files()
+            self.kernel = None
+            dirty = [index for index in range(PARAMETER_COUNT) if index != UPDATE_PARAMS]
+            self._write(values, dirty)
+        self.writes += len(dirty)
+        return len(dirty)
+
+    def safe_order(self, values, dirty):
+        # an antideadzone above its deadzone flips the sign of the
+        # reported value: lowered antideadzones go first, raised ones last
+        lowered = [index for index in dirty if PARAMETER_NAMES[index].endswith("_antideadzone")
+                   and values[index] < self.kernel[index]]
+        raised = [index for index in dirty if PARAMETER_NAMES[index].endswith("_antideadzone")
+                  and values[index] > self.kernel[index]]
+        others = [index for index in dirty if not PARAMETER_NAMES[index].endswith("_antideadzone")]
+        return lowered + others + raised
+
+    def wait_update(self, start, timeout=ACK_TIMEOUT):
+        # polls update_params until the driver clears it, returns the
+        # latency since start or None on timeout. The timeout runs from
+        # the call, start may be older.
+        polled = time.monotonic()
+        try:
+            while True:
+                self.syscalls += 1
+                if int(os.pread(self.fd(UPDATE_PARAMS), 32, 0).split(b"\n")[0]) == 0:
+                    self.ack_last = time.monotonic() - start
+                    self.ack_max = max(self.ack_max, self.ack_last)
+                    return self.ack_last
+                if time.monotonic() - polled > timeout:
+                    break
+                time.sleep(ACK_POLL)
+        except OSError:
+            pass
+        self.ack_last = None
+        self.ack_timeouts += 1
+        return None
+
+    def pwrite(self, fd, data):
+        os.pwrite(fd, data, 0)
+        self.syscalls += 1
+        if self.regular:
+            os.ftruncate(fd, len(data))
+            self.syscalls += 1
+
+    def _write(self, values, dirty):
+        # update_params last, the driver reloads the ranges once it is set
+        for index in dirty:
+            self.pwrite(self.fd(index), f"{values[index]}\n".encode())
+        self.pwrite(self.fd(UPDATE_PARAMS), b"1\n")
+        if self.kernel is None:
+            self.kernel = array('i', values)
+        for index in dirty:
+            self.kernel[index] = values[index]
+
+    def _write_batch(self, values):
+        # the driver applies the record at once and sets update_params
+        record = " ".join(str(values[index]) for index in BATCH_INDEXES) + "\n"
+        self.pwrite(self.batch_file(), record.encode())
+        self.kernel = array('i', values)
+
+    def close_files(self):
+        if self.batch_fd is not None:
+            os.close(self.batch_fd)
+            self.batch_fd = None
+        for index, fd in enumerate(self.fds):
+            if fd is not None:
+                os.close(fd)
+                self.fds[index] = None
+
+    def close(self):
+        if self.inotify is not None:
+            os.close(self.inotify)
+            self.inotify = None
+        self.close_files()
+
+_sysfs_parameters = {}
+
+def sysfs_parameters(path):
+    # one set of descriptors per parameters directory, shared by every
+    # RPCalibration using it
+    path = Path(path)
+    if path not in _sysfs_parameters:
+        _sysfs_parameters[path] = SysfsParameters(path)
+    return _sysfs_parameters[path]
+
 
 class RPCalibration:
+    __slots__ = ("syspath", "sysfs", "values", "defaults", "default_axis_max", "default_trigger_max",
+                 "staged", "errors", "pending", "committed", "requested")
+
     def __init__(self, path="/sys/module/retroid/parameters", default_axis_max=DEFAULT_AXIS_MAX, default_trigger_max=DEFAULT_TRIGGER_MAX):
         self.syspath = Path(path)
-        self.load_parameters()
+        self.sysfs = sysfs_parameters(path)
+        self.values = array('i', [row[2] for row in PARAMETERS])
+        self.staged = {}
+        self.errors = []
+        self.pending = False
+        self.committed = None   # time of the first commit waiting for a flush
+        self.requested = 0      # values committed, see sysfs.writes for the ones written
+        self.load_parameters(cached=True)
         self.default_axis_max = default_axis_max
         self.default_trigger_max = default_trigger_max
+        self.defaults = array('i', [row[2] for row in PARAMETERS])
+        for axis in PARAMETER_AXES:
+            self.defaults[PARAMETER_INDEX[f"axis_{axis}_max"]] = default_axis_max
+            self.defaults[PARAMETER_INDEX[f"axis_{axis}_min"]] = -default_axis_max
+        for trigger in PARAMETER_TRIGGERS:
+            self.defaults[PARAMETER_INDEX[f"trigger_{trigger}_max"]] = default_trigger_max
 
-    def load_parameters(self):
+    def load_parameters(self, cached=False):
         try:
-            with open(self.syspath / "axis_leftx_antideadzone","r") as fparam:
-                self.axis_leftx_antideadzone = int(fparam.readline())
-            with open(self.syspath / "axis_leftx_center","r") as fparam:
-                self.axis_leftx_center = int(fparam.readline())
-            with open(self.syspath / "axis_leftx_deadzone","r") as fparam:
-                self.axis_leftx_deadzone = int(fparam.readline())
-            with open(self.syspath / "axis_leftx_max","r") as fparam:
-                self.axis_leftx_max = int(fparam.readline())
-            with open(self.syspath / "axis_leftx_min","r") as fparam:
-                self.axis_leftx_min = int(fparam.readline())
-            with open(self.syspath / "axis_lefty_antideadzone","r") as fparam:
-                self.axis_lefty_antideadzone = int(fparam.readline())
-            with open(self.syspath / "axis_lefty_center","r") as fparam:
-                self.axis_lefty_center = int(fparam.readline())
-            with open(self.syspath / "axis_lefty_deadzone","r") as fparam:
-                self.axis_lefty_deadzone = int(fparam.readline())
-            with open(self.syspath / "axis_lefty_max","r") as fparam:
-                self.axis_lefty_max = int(fparam.readline())
-            with open(self.syspath / "axis_lefty_min","r") as fparam:
-                self.axis_lefty_min = int(fparam.readline())
-            with open(self.syspath / "axis_leftz_antideadzone","r") as fparam:
-                self.axis_leftz_antideadzone = int(fparam.readline())
-            with open(self.syspath / "axis_leftz_center","r") as fparam:
-                self.axis_leftz_center = int(fparam.readline())
-            with open(self.syspath / "axis_leftz_deadzone","r") as fparam:
-                self.axis_leftz_deadzone = int(fparam.readline())
-            with open(self.syspath / "axis_leftz_max","r") as fparam:
-                self.axis_leftz_max = int(fparam.readline())
-            with open(self.syspath / "axis_leftz_min","r") as fparam:
-                self.axis_leftz_min = int(fparam.readline())
-            with open(self.syspath / "axis_rightx_antideadzone","r") as fparam:
-                self.axis_rightx_antideadzone = int(fparam.readline())
-            with open(self.syspath / "axis_rightx_center","r") as fparam:
-                self.axis_rightx_center = int(fparam.readline())
-            with open(self.syspath / "axis_rightx_deadzone","r") as fparam:
-                self.axis_rightx_deadzone = int(fparam.readline())
-            with open(self.syspath / "axis_rightx_max","r") as fparam:
-                self.axis_rightx_max = int(fparam.readline())
-            with open(self.syspath / "axis_rightx_min","r") as fparam:
-                self.axis_rightx_min = int(fparam.readline())
-            with open(self.syspath / "axis_righty_antideadzone","r") as fparam:
-                self.axis_righty_antideadzone = int(fparam.readline())
-            with open(self.syspath / "axis_righty_center","r") as fparam:
-                self.axis_righty_center = int(fparam.readline())
-            with open(self.syspath / "axis_righty_deadzone","r") as fparam:
-                self.axis_righty_deadzone = int(fparam.readline())
-            with open(self.syspath / "axis_righty_max","r") as fparam:
-                self.axis_righty_max = int(fparam.readline())
-            with open(self.syspath / "axis_righty_min","r") as fparam:
-                self.axis_righty_min = int(fparam.readline())
-            with open(self.syspath / "axis_rightz_antideadzone","r") as fparam:
-                self.axis_rightz_antideadzone = int(fparam.readline())
-            with open(self.syspath / "axis_rightz_center","r") as fparam:
-                self.axis_rightz_center = int(fparam.readline())
-            with open(self.syspath / "axis_rightz_deadzone","r") as fparam:
-                self.axis_rightz_deadzone = int(fparam.readline())
-            with open(self.syspath / "axis_rightz_max","r") as fparam:
-                self.axis_rightz_max = int(fparam.readline())
-            with open(self.syspath / "axis_rightz_min","r") as fparam:
-                self.axis_rightz_min = int(fparam.readline())
-            with open(self.syspath / "trigger_left_antideadzone","r") as fparam:
-                self.trigger_left_antideadzone = int(fparam.readline())
-            with open(self.syspath / "trigger_left_deadzone","r") as fparam:
-                self.trigger_left_deadzone = int(fparam.readline())
-            with open(self.syspath / "trigger_left_max","r") as fparam:
-                self.trigger_left_max = int(fparam.readline())
-            with open(self.syspath / "trigger_right_antideadzone","r") as fparam:
-                self.trigger_right_antideadzone = int(fparam.readline())
-            with open(self.syspath / "trigger_right_deadzone","r") as fparam:
-                self.trigger_right_deadzone = int(fparam.readline())
-            with open(self.syspath / "trigger_right_max","r") as fparam:
-                self.trigger_right_max = int(fparam.readline())
-            with open(self.syspath / "update_params","r") as fparam:
-                self.update_params = int(fparam.readline())
+            if cached:
+                self.values[:] = self.sysfs.cached()
+            else:
+                self.values[:] = self.sysfs.read_all()
 
         except IOError as e:
             print(f"I/O error({e.errno}): {e.strerror}")
@@ -114,7 +346,9 @@ class RPCalibration:
             print(f"Unexpected error:{sys.exc_info()[0]}")
             exit(1)
 
-    def save_parameters(self, savepath):
+    def save_parameters(self, savepath, values=None):
+        if values is None:
+            values = self.values
         with open(savepath,"w") as savefile:
             savefile.write("#!/usr/bin/env bash\n")
             savefile.write("#\n")
@@ -122,121 +356,17 @@ class RPCalibration:
             savefile.write("# Made with the Kdog GPcal tool\n")
             savefile.write("# SPDX-License-Identifier: MIT\n")
             savefile.write("#\n")
-            savefile.write(f"echo {self.axis_leftx_antideadzone} > {self.syspath}/axis_leftx_antideadzone\n")
-            savefile.write(f"echo {self.axis_leftx_center} > {self.syspath}/axis_leftx_center\n")
-            savefile.write(f"echo {self.axis_leftx_deadzone} > {self.syspath}/axis_leftx_deadzone\n")
-            savefile.write(f"echo {self.axis_leftx_max} > {self.syspath}/axis_leftx_max\n")
-            savefile.write(f"echo {self.axis_leftx_min} > {self.syspath}/axis_leftx_min\n")
-            savefile.write(f"echo {self.axis_lefty_antideadzone} > {self.syspath}/axis_lefty_antideadzone\n")
-            savefile.write(f"echo {self.axis_lefty_center} > {self.syspath}/axis_lefty_center\n")
-            savefile.write(f"echo {self.axis_lefty_deadzone} > {self.syspath}/axis_lefty_deadzone\n")
-            savefile.write(f"echo {self.axis_lefty_max} > {self.syspath}/axis_lefty_max\n")
-            savefile.write(f"echo {self.axis_lefty_min} > {self.syspath}/axis_lefty_min\n")
-            savefile.write(f"echo {self.axis_leftz_antideadzone} > {self.syspath}/axis_leftz_antideadzone\n")
-            savefile.write(f"echo {self.axis_leftz_center} > {self.syspath}/axis_leftz_center\n")
-            savefile.write(f"echo {self.axis_leftz_deadzone} > {self.syspath}/axis_leftz_deadzone\n")
-            savefile.write(f"echo {self.axis_leftz_max} > {self.syspath}/axis_leftz_max\n")
-            savefile.write(f"echo {self.axis_leftz_min} > {self.syspath}/axis_leftz_min\n")
-            savefile.write(f"echo {self.axis_rightx_antideadzone} > {self.syspath}/axis_rightx_antideadzone\n")
-            savefile.write(f"echo {self.axis_rightx_center} > {self.syspath}/axis_rightx_center\n")
-            savefile.write(f"echo {self.axis_rightx_deadzone} > {self.syspath}/axis_rightx_deadzone\n")
-            savefile.write(f"echo {self.axis_rightx_max} > {self.syspath}/axis_rightx_max\n")
-            savefile.write(f"echo {self.axis_rightx_min} > {self.syspath}/axis_rightx_min\n")
-            savefile.write(f"echo {self.axis_righty_antideadzone} > {self.syspath}/axis_righty_antideadzone\n")
-            savefile.write(f"echo {self.axis_righty_center} > {self.syspath}/axis_righty_center\n")
-            savefile.write(f"echo {self.axis_righty_deadzone} > {self.syspath}/axis_righty_deadzone\n")
-            savefile.write(f"echo {self.axis_righty_max} > {self.syspath}/axis_righty_max\n")
-            savefile.write(f"echo {self.axis_righty_min} > {self.syspath}/axis_righty_min\n")
-            savefile.write(f"echo {self.axis_rightz_antideadzone} > {self.syspath}/axis_rightz_antideadzone\n")
-            savefile.write(f"echo {self.axis_rightz_center} > {self.syspath}/axis_rightz_center\n")
-            savefile.write(f"echo {self.axis_rightz_deadzone} > {self.syspath}/axis_rightz_deadzone\n")
-            savefile.write(f"echo {self.axis_rightz_max} > {self.syspath}/axis_rightz_max\n")
-            savefile.write(f"echo {self.axis_rightz_min} > {self.syspath}/axis_rightz_min\n")
-            savefile.write(f"echo {self.trigger_left_antideadzone} > {self.syspath}/trigger_left_antideadzone\n")
-            savefile.write(f"echo {self.trigger_left_deadzone} > {self.syspath}/trigger_left_deadzone\n")
-            savefile.write(f"echo {self.trigger_left_max} > {self.syspath}/trigger_left_max\n")
-            savefile.write(f"echo {self.trigger_right_antideadzone} > {self.syspath}/trigger_right_antideadzone\n")
-            savefile.write(f"echo {self.trigger_right_deadzone} > {self.syspath}/trigger_right_deadzone\n")
-            savefile.write(f"echo {self.trigger_right_max} > {self.syspath}/trigger_right_max\n")
+            for index, name in enumerate(PARAMETER_NAMES):
+                if index != UPDATE_PARAMS:
+                    savefile.write(f"echo {values[index]} > {self.syspath}/{name}\n")
             savefile.write(f"echo 1 > {self.syspath}/update_params\n")
 
-    def apply_parameters(self):
+    def apply_parameters(self, full=False):
+        # only the values changed since the last read or write reach
+        # the driver, full=True writes all of them
         self.update_params=1
         try:
-            with open(self.syspath / "axis_leftx_antideadzone","w") as fparam:
-                fparam.write(f"{self.axis_leftx_antideadzone}")
-            with open(self.syspath / "axis_leftx_center","w") as fparam:
-                fparam.write(f"{self.axis_leftx_center}")
-            with open(self.syspath / "axis_leftx_deadzone","w") as fparam:
-                fparam.write(f"{self.axis_leftx_deadzone}")
-            with open(self.syspath / "axis_leftx_max","w") as fparam:
-                fparam.write(f"{self.axis_leftx_max}")
-            with open(self.syspath / "axis_leftx_min","w") as fparam:
-                fparam.write(f"{self.axis_leftx_min}")
-            with open(self.syspath / "axis_lefty_antideadzone","w") as fparam:
-                fparam.write(f"{self.axis_lefty_antideadzone}")
-            with open(self.syspath / "axis_lefty_center","w") as fparam:
-                fparam.write(f"{self.axis_lefty_center}")
-            with open(self.syspath / "axis_lefty_deadzone","w") as fparam:
-                fparam.write(f"{self.axis_lefty_deadzone}")
-            with open(self.syspath / "axis_lefty_max","w") as fparam:
-                fparam.write(f"{self.axis_lefty_max}")
-            with open(self.syspath / "axis_lefty_min","w") as fparam:
-                fparam.write(f"{self.axis_lefty_min}")
-            with open(self.syspath / "axis_leftz_antideadzone","w") as fparam:
-                fparam.write(f"{self.axis_leftz_antideadzone}")
-            with open(self.syspath / "axis_leftz_center","w") as fparam:
-                fparam.write(f"{self.axis_leftz_center}")
-            with open(self.syspath / "axis_leftz_deadzone","w") as fparam:
-                fparam.write(f"{self.axis_leftz_deadzone}")
-            with open(self.syspath / "axis_leftz_max","w") as fparam:
-                fparam.write(f"{self.axis_leftz_max}")
-            with open(self.syspath / "axis_leftz_min","w") as fparam:
-                fparam.write(f"{self.axis_leftz_min}")
-            with open(self.syspath / "axis_rightx_antideadzone","w") as fparam:
-                fparam.write(f"{self.axis_rightx_antideadzone}")
-            with open(self.syspath / "axis_rightx_center","w") as fparam:
-                fparam.write(f"{self.axis_rightx_center}")
-            with open(self.syspath / "axis_rightx_deadzone","w") as fparam:
-                fparam.write(f"{self.axis_rightx_deadzone}")
-            with open(self.syspath / "axis_rightx_max","w") as fparam:
-                fparam.write(f"{self.axis_rightx_max}")
-            with open(self.syspath / "axis_rightx_min","w") as fparam:
-                fparam.write(f"{self.axis_rightx_min}")
-            with open(self.syspath / "axis_righty_antideadzone","w") as fparam:
-                fparam.write(f"{self.axis_righty_antideadzone}")
-            with open(self.syspath / "axis_righty_center","w") as fparam:
-                fparam.write(f"{self.axis_righty_center}")
-            with open(self.syspath / "axis_righty_deadzone","w") as fparam:
-                fparam.write(f"{self.axis_righty_deadzone}")
-            with open(self.syspath / "axis_righty_max","w") as fparam:
-                fparam.write(f"{self.axis_righty_max}")
-            with open(self.syspath / "axis_righty_min","w") as fparam:
-                fparam.write(f"{self.axis_righty_min}")
-            with open(self.syspath / "axis_rightz_antideadzone","w") as fparam:
-                fparam.write(f"{self.axis_rightz_antideadzone}")
-            with open(self.syspath / "axis_rightz_center","w") as fparam:
-                fparam.write(f"{self.axis_rightz_center}")
-            with open(self.syspath / "axis_rightz_deadzone","w") as fparam:
-                fparam.write(f"{self.axis_rightz_deadzone}")
-            with open(self.syspath / "axis_rightz_max","w") as fparam:
-                fparam.write(f"{self.axis_rightz_max}")
-            with open(self.syspath / "axis_rightz_min","w") as fparam:
-                fparam.write(f"{self.axis_rightz_min}")
-            with open(self.syspath / "trigger_left_antideadzone","w") as fparam:
-                fparam.write(f"{self.trigger_left_antideadzone}")
-            with open(self.syspath / "trigger_left_deadzone","w") as fparam:
-                fparam.write(f"{self.trigger_left_deadzone}")
-            with open(self.syspath / "trigger_left_max","w") as fparam:
-                fparam.write(f"{self.trigger_left_max}")
-            with open(self.syspath / "trigger_right_antideadzone","w") as fparam:
-                fparam.write(f"{self.trigger_right_antideadzone}")
-            with open(self.syspath / "trigger_right_deadzone","w") as fparam:
-                fparam.write(f"{self.trigger_right_deadzone}")
-            with open(self.syspath / "trigger_right_max","w") as fparam:
-                fparam.write(f"{self.trigger_right_max}")
-            with open(self.syspath / "update_params","w") as fparam:
-                fparam.write(f"{self.update_params}")
+            self.sysfs.write(self.values, full)
         except IOError as e:
             print(f"I/O error({e.errno}): {e.strerror}")
             exit(1)
@@ -244,53 +374,139 @@ class RPCalibration:
             print(f"Unexpected error:{sys.exc_info()[0]}")
             exit(1)
 
-    def reset_axis_left(self):
-        self.axis_leftx_antideadzone=0
-        self.axis_leftx_center=0
-        self.axis_leftx_deadzone=0
-        self.axis_leftx_max=self.default_axis_max
-        self.axis_leftx_min=-self.default_axis_max
-        self.axis_lefty_antideadzone=0
-        self.axis_lefty_center=0
-        self.axis_lefty_deadzone=0
-        self.axis_lefty_max=self.default_axis_max
-        self.axis_lefty_min=-self.default_axis_max
-        self.axis_leftz_antideadzone=0
-        self.axis_leftz_center=0
-        self.axis_leftz_deadzone=0
-        self.axis_leftz_max=self.default_axis_max
-        self.axis_leftz_min=-self.default_axis_max
+    def snapshot(self):
+        # a copy of the values, cheap enough to keep many of them
+        return array('i', self.values)
+
+    def restore(self, values):
+        # stages the parameters which differ from a snapshot, values
+        # saved from this object are trusted. What is staged and not
+        # committed yet (a calibration in progress) is dropped.
+        self.rollback()
+        for index in range(PARAMETER_COUNT):
+            if values[index] != self.values[index] and index != UPDATE_PARAMS:
+                self.staged[index] = values[index]
+        self.commit(check=False)
+
+    def validate(self, values=None, indexes=None):
+        # the reasons why the values can't be given to the driver, only
+        # the controls of the given parameters are checked
+        if values is None:
+            values = self.values
+        if indexes is None:
+            indexes = range(PARAMETER_COUNT)
+        errors = [f"{PARAMETER_NAMES[index]} out of range" for index in indexes
+                  if not PARAMETERS[index][3] <= values[index] <= PARAMETERS[index][4]]
+        controls = {PARAMETER_NAMES[index].rsplit("_", 1)[0] for index in indexes}
+        for axis in PARAMETER_AXES:
+            prefix = f"axis_{axis}"
+            if prefix not in controls:
+                continue
+            if values[PARAMETER_INDEX[f"{prefix}_min"]] >= values[PARAMETER_INDEX[f"{prefix}_max"]]:
+                errors.append(f"{prefix} min >= max")
+            if values[PARAMETER_INDEX[f"{prefix}_antideadzone"]] > values[PARAMETER_INDEX[f"{prefix}_deadzone"]]:
+                errors.append(f"{prefix} antideadzone > deadzone")
+        for trigger in PARAMETER_TRIGGERS:
+            prefix = f"trigger_{trigger}"
+            if prefix not in controls:
+                continue
+            if values[PARAMETER_INDEX[f"{prefix}_antideadzone"]] > values[PARAMETER_INDEX[f"{prefix}_deadzone"]]:
+                errors.append(f"{prefix} antideadzone > deadzone")
+        return errors
+
+    def stage(self, **parameters):
+        # changes kept aside until commit()
+        for name, value in parameters.items():
+            self.staged[PARAMETER_INDEX[name]] = int(value)
+
+    def staged_values(self):
+        values = self.snapshot()
+        for index, value in self.staged.items():
+            values[index] = value
+        return values
+
+    def rollback(self):
+        self.staged = {}
+
+    def commit(self, check=True):
+        # validates the staged changes and queues them for the next
+        # flush(), several commits between two flushes end up in a single
+        # write. Returns False and keeps the current values when they are
+        # rejected.
+        values = self.staged_values()
+        self.errors = self.validate(values, list(self.staged)) if check else []
+        staged = len(self.staged)
+        self.staged = {}
+        if self.errors:
+            return False
+        self.requested += staged
+        self.values[:] = values
+        if not self.pending:
+            self.committed = time.monotonic()
+        self.pending = True
+        return True
+
+    def take_pending(self):
+        # snapshot of the committed values to write, None if there is
+        # nothing new since the last flush
+        if not self.pending:
+            return None
+        self.pending = False
+        return self.snapshot()
+
+    def write_values(self, values, start=None, wait=True):
+        # flush() of a snapshot, for the I/O thread: the errors are
+        # raised instead of ending the program. start is the time of the
+        # commit, the latency includes the wait for the I/O thread.
+        if start is None:
+            start = time.monotonic()
+        self.sysfs.write(values)
+        if wait and self.sysfs.syscalls:
+            self.sysfs.wait_update(start)
+
+    def flush(self, wait=True):
+        # writes the committed values, update_params last, then waits for
+        # the driver to take them
+        if not self.pending:
+            return
+        self.pending = False
+        start = self.committed
         self.apply_parameters()
+        if wait and self.sysfs.syscalls:
+            self.sysfs.wait_update(start)
+
+    def refresh(self, changed=None):
+        # follows the parameters changed by other programs, the values
+        # committed or staged here still win on the next flush. changed
+        # is the result of sysfs.refresh() when it runs in another thread.
+        if changed is None:
+            changed = self.sysfs.refresh()
+        for index, value in changed.items():
+            if not self.pending and index not in self.staged:
+                self.values[index] = value
+        return [PARAMETER_NAMES[index] for index in changed]
+
+    def to_dict(self):
+        return {name: self.values[index] for index, name in enumerate(PARAMETER_NAMES)
+                if index != UPDATE_PARAMS}
+
+    def reset(self, group):
+        for index, row in enumerate(PARAMETERS):
+            if row[1] == group:
+                self.staged[index] = self.defaults[index]
+        self.commit()
+
+    def reset_axis_left(self):
+        self.reset("axis_left")
 
     def reset_axis_right(self):
-        self.axis_rightx_antideadzone=0
-        self.axis_rightx_center=0
-        self.axis_rightx_deadzone=0
-        self.axis_rightx_max=self.default_axis_max
-        self.axis_rightx_min=-self.default_axis_max
-        self.axis_righty_antideadzone=0
-        self.axis_righty_center=0
-        self.axis_righty_deadzone=0
-        self.axis_righty_max=self.default_axis_max
-        self.axis_righty_min=-self.default_axis_max
-        self.axis_rightz_antideadzone=0
-        self.axis_rightz_center=0
-        self.axis_rightz_deadzone=0
-        self.axis_rightz_max=self.default_axis_max
-        self.axis_rightz_min=-self.default_axis_max
-        self.apply_parameters()
+        self.reset("axis_right")
 
     def reset_trigger_left(self):
-        self.trigger_left_antideadzone=0
-        self.trigger_left_deadzone=0
-        self.trigger_left_max=self.default_trigger_max
-        self.apply_parameters()
+        self.reset("trigger_left")
 
     def reset_trigger_right(self):
-        self.trigger_right_antideadzone=0
-        self.trigger_right_deadzone=0
-        self.trigger_right_max=self.default_trigger_max
-        self.apply_parameters()
+        self.reset("trigger_right")
 
     def reset_all(self):
         self.reset_axis_left()
@@ -298,41 +514,157 @@ class RPCalibration:
         self.reset_trigger_left()
         self.reset_trigger_right()
     
+    def close(self):
+        self.sysfs.close()
+
     def __str__(self):
-        return f"self.axis_leftx_antideadzone={self.axis_leftx_antideadzone}\n" \
-                +f"self.axis_leftx_center={self.axis_leftx_center}\n" \
-                +f"self.axis_leftx_deadzone={self.axis_leftx_deadzone}\n" \
-                +f"self.axis_leftx_max={self.axis_leftx_max}\n" \
-                +f"self.axis_leftx_min={self.axis_leftx_min}\n" \
-                +f"self.axis_lefty_antideadzone={self.axis_lefty_antideadzone}\n" \
-                +f"self.axis_lefty_center={self.axis_lefty_center}\n" \
-                +f"self.axis_lefty_deadzone={self.axis_lefty_deadzone}\n" \
-                +f"self.axis_lefty_max={self.axis_lefty_max}\n" \
-                +f"self.axis_lefty_min={self.axis_lefty_min}\n" \
-                +f"self.axis_leftz_antideadzone={self.axis_leftz_antideadzone}\n" \
-                +f"self.axis_leftz_center={self.axis_leftz_center}\n" \
-                +f"self.axis_leftz_deadzone={self.axis_leftz_deadzone}\n" \
-                +f"self.axis_leftz_max={self.axis_leftz_max}\n" \
-                +f"self.axis_leftz_min={self.axis_leftz_min}\n" \
-                +f"self.axis_rightx_antideadzone={self.axis_rightx_antideadzone}\n" \
-                +f"self.axis_rightx_center={self.axis_rightx_center}\n" \
-                +f"self.axis_rightx_deadzone={self.axis_rightx_deadzone}\n" \
-                +f"self.axis_rightx_max={self.axis_rightx_max}\n" \
-                +f"self.axis_rightx_min={self.axis_rightx_min}\n" \
-                +f"self.axis_righty_antideadzone={self.axis_righty_antideadzone}\n" \
-                +f"self.axis_righty_center={self.axis_righty_center}\n" \
-                +f"self.axis_righty_deadzone={self.axis_righty_deadzone}\n" \
-                +f"self.axis_righty_max={self.axis_righty_max}\n" \
-                +f"self.axis_righty_min={self.axis_righty_min}\n" \
-                +f"self.axis_rightz_antideadzone={self.axis_rightz_antideadzone}\n" \
-                +f"self.axis_rightz_center={self.axis_rightz_center}\n" \
-                +f"self.axis_rightz_deadzone={self.axis_rightz_deadzone}\n" \
-                +f"self.axis_rightz_max={self.axis_rightz_max}\n" \
-                +f"self.axis_rightz_min={self.axis_rightz_min}\n" \
-                +f"self.trigger_left_antideadzone={self.trigger_left_antideadzone}\n" \
-                +f"self.trigger_left_deadzone={self.trigger_left_deadzone}\n" \
-                +f"self.trigger_left_max={self.trigger_left_max}\n" \
-                +f"self.trigger_right_antideadzone={self.trigger_right_antideadzone}\n" \
-                +f"self.trigger_right_deadzone={self.trigger_right_deadzone}\n" \
-                +f"self.trigger_right_max={self.trigger_right_max}\n" \
-                +f"self.update_params={self.update_params}\n"
+        return "".join(f"self.{name}={self.values[index]}\n" for index, name in enumerate(PARAMETER_NAMES))
+
+def _parameter_property(index):
+    def getter(self):
+        return self.values[index]
+    def setter(self, value):
+        self.values[index] = value
+    return property(getter, setter)
+
+# expose the values as attributes: axis_leftx_center, trigger_left_max...
+for index, name in enumerate(PARAMETER_NAMES):
+    setattr(RPCalibration, name, _parameter_property(index))
+
+
+class RPHistory:
+    # Bounded undo/redo over snapshots of a RPCalibration
+    def __init__(self, calibration, size=HISTORY_SIZE):
+        self.calibration = calibration
+        self.undos = deque(maxlen=size)
+        self.redos = []
+
+    def push(self):
+        # to call before the values change
+        self.undos.append(self.calibration.snapshot())
+        self.redos = []
+
+    def cancel(self):
+        # back to the last snapshot, the changes made since are forgotten
+        if self.undos:
+            self.calibration.restore(self.undos.pop())
+
+    def undo(self):
+        if not self.undos:
+            return False
+        self.redos.append(self.calibration.snapshot())
+        self.calibration.restore(self.undos.pop())
+        return True
+
+    def redo(self):
+        if not self.redos:
+            return False
+        self.undos.append(self.calibration.snapshot())
+        self.calibration.restore(self.redos.pop())
+        return True
+
+
+class RPProfiles:
+    # Named calibrations in a single JSON file. The parameter names are
+    # written once, each profile is the list of its values in that order.
+    def __init__(self, path=PROFILES_PATH):
+        self.path = Path(path)
+        self.default = None
+        self.profiles = {}
+        self.devices = {}       # device key: profile name
+        self.error = None       # why the file couldn't be loaded
+        self.load()
+
+    def load(self):
+        # a damaged file or one of another version leaves no profiles and
+        # the reason in self.error
+        self.error = None
+        try:
+            with open(self.path, "r") as profilefile:
+                data = json.load(profilefile)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as e:
+            self.error = f"{self.path}: {e}"
+            return
+        try:
+            if data.get("version") != PROFILES_VERSION:
+                self.error = f"{self.path}: unknown profiles version {data.get('version')}"
+                return
+            names = data["parameters"]
+            unknown = [name for name in names if name not in PARAMETER_INDEX]
+            if unknown:
+                raise ValueError(f"unknown parameters {', '.join(unknown)}")
+            # a profile sets every parameter, serialise() writes them all
+            missing = [name for name in PARAMETER_NAMES if name not in names and name != "update_params"]
+            if missing:
+                raise ValueError(f"missing parameters {', '.join(missing)}")
+            for name, values in data["profiles"].items():
+                if len(values) != len(names):
+                    raise ValueError(f"{len(values)} values in profile {name}, {len(names)} expected")
+            profiles = {name: dict(zip(names, values)) for name, values in data["profiles"].items()}
+            if not all(type(value) is int for profile in profiles.values() for value in profile.values()):
+                raise ValueError("values which are not integers")
+            self.default = data.get("default")
+            self.devices = dict(data.get("devices", {}))
+            self.profiles = profiles
+        except (AttributeError, KeyError, TypeError, ValueError) as e:
+            self.error = f"{self.path}: damaged profiles, {e}"
+
+    def serialise(self):
+        names = [name for name in PARAMETER_NAMES if name != "update_params"]
+        data = {
+            "version": PROFILES_VERSION,
+            "parameters": names,
+            "default": self.default,
+            "devices": self.devices,
+            "profiles": {name: [profile[parameter] for parameter in names]
+                         for name, profile in self.profiles.items()},
+        }
+        return json.dumps(data, separators=(",", ":"))
+
+    def write(self, text):
+        # replaces the file at once, a crash leaves the previous one
+        tmppath = self.path.with_name(self.path.name + ".tmp")
+        with open(tmppath, "w") as profilefile:
+            profilefile.write(text)
+        os.replace(tmppath, self.path)
+
+    def put(self, name, calibration, default=True, device=None):
+        # device is the device_key() of the unit the profile belongs to
+        self.profiles[name] = calibration.to_dict()
+        if default:
+            self.default = name
+        if device is not None:
+            self.devices[device] = name
+
+    def get(self, name=None):
+        # the named profile or the default one, None if there is none
+        if name is None:
+            name = self.default
+        return self.profiles.get(name)
+
+    def find(self, device):
+        # name of the profile saved for a unit, None if there is none
+        name = self.devices.get(device)
+        return name if name in self.profiles else None
+
+def board_serial():
+    for path in SERIAL_PATHS:
+        try:
+            serial = Path(path).read_bytes().rstrip(b"\0").decode().strip()
+        except (OSError, UnicodeDecodeError):
+            continue
+        if serial:
+            return serial
+    return "unknown"
+
+def device_key(event_path, serial=None):
+    # "bus:vendor:product:version/serial" of the gamepad on a unit, None
+    # if the event node can't be queried
+    info = device_info(event_path)
+    if info is None:
+        return None
+    if serial is None:
+        serial = board_serial()
+    return ":".join(f"{n:04x}" for n in info[1]) + "/" + serial
@@ -0,0 +1,67 @@
+"""
+    GPcal apply: restore a saved calibration without the UI, from a boot
+    script for example:
+
+        python3 apply.py [profile] [--profiles FILE] [--export SCRIPT]
+
+    Author: Kdog
+    Version: 0.1
+    SPDX-License-Identifier: MIT
+"""
+import argparse
+import sys
+
+from Klib.Evdev import find_device
+from Klib.RPocket import RPCalibration, RPProfiles, PROFILES_PATH, GAMEPAD_NAME, device_key
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Apply a calibration saved by GPcal")
+    parser.add_argument("profile", nargs="?", help="profile to apply, the one of this unit or the last saved one by default")
+    parser.add_argument("--profiles", default=PROFILES_PATH, help=f"profiles file ({PROFILES_PATH})")
+    parser.add_argument("--parameters", default="/sys/module/retroid/parameters", help="driver parameters directory")
+    parser.add_argument("--export", metavar="SCRIPT", help="write the profile as a bash script instead of applying it")
+    parser.add_argument("--list", action="store_true", help="list the saved profiles")
+    args = parser.parse_args()
+
+    profiles = RPProfiles(args.profiles)
+    if profiles.error is not None:
+        print(f"Profiles not loaded: {profiles.error}")
+        return 1
+    if args.list:
+        for name in profiles.profiles:
+            print(f"{name}{' (default)' if name == profiles.default else ''}")
+        return 0
+
+    name = args.profile
+    if name is None:
+        # the profile saved for this unit, looked up by its identity
+        event_path = find_device(GAMEPAD_NAME)
+        if event_path is not None:
+            name = profiles.find(device_key(event_path))
+    if name is None:
+        name = profiles.default
+    profile = profiles.get(name)
+    if profile is None:
+        print(f"No profile {name or '(default)'} in {args.profiles}")
+        return 1
+
+    calibration = RPCalibration(args.parameters)
+    calibration.stage(**profile)
+    if not calibration.commit():
+        print(f"Profile rejected: {', '.join(calibration.errors)}")
+        return 1
+
+    if args.export:
+        calibration.save_parameters(args.export)
+        print(f"Profile {name} exported to {args.export}")
+        return 0
+
+    # the values already in the driver are not written again
+    calibration.flush(wait=False)
+    print(f"Profile {name} applied, {calibration.sysfs.writes} values written")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
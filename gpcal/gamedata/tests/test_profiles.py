@@ -0,0 +1,71 @@
+"""
+    Tests of the loading of the profiles file of RPocket
+    Author: Kdog
+    Version: 0.1
+    SPDX-License-Identifier: MIT
+"""
+
+import json
+from pathlib import Path
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from Klib.RPocket import RPProfiles, PARAMETERS, PROFILES_VERSION
+
+NAMES=[name for (name, *_) in PARAMETERS if name != "update_params"]
+VALUES=[default for (name, _, default, _, _) in PARAMETERS if name != "update_params"]
+
+
+class TestLoad(unittest.TestCase):
+    def load(self, data):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        path = Path(tmp.name) / "profiles.json"
+        path.write_text(data if isinstance(data, str) else json.dumps(data))
+        return RPProfiles(path)
+
+    def data(self, names=NAMES, values=VALUES):
+        return {"version": PROFILES_VERSION, "parameters": names, "default": "p",
+                "devices": {}, "profiles": {"p": values}}
+
+    def assertRejected(self, profiles):
+        self.assertIsNotNone(profiles.error)
+        self.assertEqual(profiles.profiles, {})
+        self.assertIsNone(profiles.default)
+
+    def test_valid(self):
+        profiles = self.load(self.data())
+        self.assertIsNone(profiles.error)
+        self.assertEqual(profiles.get(), dict(zip(NAMES, VALUES)))
+        # saved back as loaded
+        self.assertEqual(json.loads(profiles.serialise())["profiles"], {"p": VALUES})
+
+    def test_damaged_json(self):
+        self.assertRejected(self.load("{bad"))
+
+    def test_unknown_version(self):
+        data = self.data()
+        data["version"] = PROFILES_VERSION + 1
+        self.assertRejected(self.load(data))
+
+    def test_unknown_parameter(self):
+        self.assertRejected(self.load(self.data(NAMES + ["axis_foo"], VALUES + [0])))
+
+    def test_missing_parameter(self):
+        self.assertRejected(self.load(self.data(NAMES[:-1], VALUES[:-1])))
+
+    def test_missing_values(self):
+        self.assertRejected(self.load(self.data(values=VALUES[:-1])))
+
+    def test_extra_values(self):
+        self.assertRejected(self.load(self.data(values=VALUES + [0])))
+
+    def test_not_integers(self):
+        self.assertRejected(self.load(self.data(values=[str(value) for value in VALUES])))
+
+
+if __name__ == "__main__":
+    unittest.main()
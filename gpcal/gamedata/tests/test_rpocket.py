@@ -0,0 +1,87 @@
+"""
+    Tests of the sysfs writes of RPocket, on a copy of the parameters
+    of the driver in a temporary directory
+    Author: Kdog
+    Version: 0.1
+    SPDX-License-Identifier: MIT
+"""
+
+import os
+from pathlib import Path
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from Klib.RPocket import (RPCalibration, SysfsParameters, PARAMETERS, PARAMETER_NAMES,
+                          BATCH_NAME, BATCH_INDEXES)
+
+
+class FakeParameters:
+    # a parameters directory filled like the driver does at boot, with
+    # values longer than the ones written by the tests
+    def __init__(self, batched):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = Path(self.tmp.name)
+        for (name, _, default, _, _) in PARAMETERS:
+            (self.path / name).write_text(f"{default}\n")
+        (self.path / "axis_leftx_max").write_text("12345\n")
+        (self.path / "axis_leftx_min").write_text("-12345\n")
+        if batched:
+            record = " ".join(str(PARAMETERS[index][2]) for index in BATCH_INDEXES)
+            (self.path / BATCH_NAME).write_text(f"{record} \n")
+
+    def text(self, name):
+        return (self.path / name).read_text()
+
+    def close(self):
+        self.tmp.cleanup()
+
+
+class TestWrites(unittest.TestCase):
+    def calibrate(self, batched):
+        fake = FakeParameters(batched)
+        self.addCleanup(fake.close)
+        calibration = RPCalibration(path=fake.path)
+        self.addCleanup(calibration.close)
+        self.assertEqual(calibration.sysfs.batched, batched)
+        calibration.stage(axis_leftx_max=900, axis_leftx_min=-900)
+        self.assertTrue(calibration.commit())
+        calibration.flush(wait=False)
+        return fake, calibration
+
+    def test_per_file(self):
+        (fake, calibration) = self.calibrate(batched=False)
+        self.assertEqual(fake.text("axis_leftx_max"), "900\n")
+        self.assertEqual(fake.text("axis_leftx_min"), "-900\n")
+        self.assertEqual(fake.text("update_params"), "1\n")
+        sysfs = SysfsParameters(fake.path)
+        self.addCleanup(sysfs.close)
+        self.assertEqual(list(sysfs.read_all()), list(calibration.values))
+
+    def test_batched(self):
+        (fake, calibration) = self.calibrate(batched=True)
+        record = fake.text(BATCH_NAME)
+        self.assertTrue(record.endswith("\n"))
+        self.assertEqual(record.count("\n"), 1)
+        fields = record.split()
+        self.assertEqual(len(fields), len(BATCH_INDEXES))
+        self.assertEqual(fields[BATCH_INDEXES.index(PARAMETER_NAMES.index("axis_leftx_max"))], "900")
+
+        # a shorter record after a longer one
+        calibration.stage(axis_leftx_max=1, axis_leftx_min=-1)
+        self.assertTrue(calibration.commit())
+        calibration.flush(wait=False)
+        sysfs = SysfsParameters(fake.path)
+        self.addCleanup(sysfs.close)
+        # update_params is set by the driver itself
+        values = sysfs.read_all()
+        self.assertEqual([values[index] for index in BATCH_INDEXES],
+                         [calibration.values[index] for index in BATCH_INDEXES])
+        self.assertEqual(os.path.getsize(fake.path / BATCH_NAME), len(fake.text(BATCH_NAME)))
+        self.assertEqual(fake.text(BATCH_NAME).count("\n"), 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,99 @@
+"""
+    bench_events: throughput of the evdev event decoding and of the
+    axis table update, on events queued through a pipe instead of the
+    gamepad node:
+
+        python3 gpcal/tools/bench_events.py [--events N] [--frames N]
+
+    Author: Kdog
+    Version: 0.1
+    SPDX-License-Identifier: MIT
+"""
+import argparse
+from array import array
+import os
+from pathlib import Path
+import struct
+import sys
+import time
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "gamedata"))
+
+import Klib.Evdev as Evdev
+from Klib.Evdev import EvdevReader, AxisTable, EVENT_FORMAT, EVENT_SIZE, EV_ABS, ABS_X, ABS_Y, ABS_RX, ABS_RY
+
+CODES=(ABS_X, ABS_Y, ABS_RX, ABS_RY)
+AXES=tuple((f"axis{code}", code, 0, 0, True) for code in CODES)
+
+
+def read_per_event(fd):
+    # one os.read() and one struct.unpack() per event, as before the
+    # batched reader
+    events = []
+    while True:
+        try:
+            events.append(struct.unpack(EVENT_FORMAT, os.read(fd, EVENT_SIZE)))
+        except OSError:
+            return events
+
+
+def bench_read(name, count, frames):
+    # Mevents/s and us/frame of the reads of count events per frame
+    frame = b"".join(struct.pack(EVENT_FORMAT, 1, index, EV_ABS, CODES[index % len(CODES)], index)
+                     for index in range(count))
+    (r, w) = os.pipe()
+    os.set_blocking(r, False)
+    reader = EvdevReader(f"/proc/self/fd/{r}")
+    total = 0
+    start = time.perf_counter()
+    for _ in range(frames):
+        os.write(w, frame)
+        total += len(read_per_event(reader.fd) if name == "per-event" else reader.read())
+    elapsed = time.perf_counter() - start
+    reader.close()
+    os.close(r)
+    os.close(w)
+    return total / elapsed / 1e6, elapsed / frames * 1e6
+
+
+def bench_update(vectorized, count, frames):
+    # Mevents/s and us/frame of AxisTable.update over count samples
+    codes = array('H', (CODES[index % len(CODES)] for index in range(count)))
+    values = array('i', ((index * 37) % 2001 - 1000 for index in range(count)))
+    table = AxisTable(AXES)
+    np = Evdev.np
+    if not vectorized:
+        Evdev.np = None
+    try:
+        start = time.perf_counter()
+        for _ in range(frames):
+            table.update(codes, values)
+        elapsed = time.perf_counter() - start
+    finally:
+        Evdev.np = np
+    return count * frames / elapsed / 1e6, elapsed / frames * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the evdev event decoding and the axis table update")
+    parser.add_argument("--events", type=int, default=200, help="events queued per frame (200)")
+    parser.add_argument("--frames", type=int, default=2000, help="number of frames (2000)")
+    args = parser.parse_args()
+
+    print(f"{args.events} events per frame, {args.frames} frames")
+    for name in ("per-event", "batched"):
+        (rate, frame) = bench_read(name, args.events, args.frames)
+        print(f"{'read ' + name:<20}|{rate:#8.2f} Mevents/s|{frame:#8.1f} us/frame")
+    # below VECTORIZE_MIN samples the table always runs the python loop
+    modes = [False]
+    if Evdev.np is not None and args.events >= Evdev.VECTORIZE_MIN:
+        modes.append(True)
+    for vectorized in modes:
+        (rate, frame) = bench_update(vectorized, args.events, args.frames)
+        name = "update " + ("numpy" if vectorized else "python")
+        print(f"{name:<20}|{rate:#8.2f} Mevents/s|{frame:#8.1f} us/frame")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -16,9 +16,11 @@
 #include <linux/kernel.h>
 #include <linux/module.h>
 #include <linux/moduleparam.h>
+#include <linux/mutex.h>
 #include <linux/of.h>
 #include <linux/serdev.h>
 #include <linux/slab.h>
+#include <linux/string.h>
 #include <uapi/linux/sched/types.h>
 
 #define DRIVER_NAME "retroid-pocket-gamepad"
@@ -156,6 +158,67 @@ module_param(axis_rightz_max,int,0660);
 module_param(axis_rightz_deadzone,int,0660);
 module_param(axis_rightz_antideadzone,int,0660);
 
+/*
+ * All the calibration parameters but update_params in a single record,
+ * in this order, read and written at once. A write sets update_params
+ * and the input handler never sees half of a calibration.
+ */
+static DEFINE_MUTEX(params_lock);
+
+static int *calibration_params[] = {
+    &axis_leftx_antideadzone, &axis_leftx_center, &axis_leftx_deadzone, &axis_leftx_max, &axis_leftx_min,
+    &axis_lefty_antideadzone, &axis_lefty_center, &axis_lefty_deadzone, &axis_lefty_max, &axis_lefty_min,
+    &axis_leftz_antideadzone, &axis_leftz_center, &axis_leftz_deadzone, &axis_leftz_max, &axis_leftz_min,
+    &axis_rightx_antideadzone, &axis_rightx_center, &axis_rightx_deadzone, &axis_rightx_max, &axis_rightx_min,
+    &axis_righty_antideadzone, &axis_righty_center, &axis_righty_deadzone, &axis_righty_max, &axis_righty_min,
+    &axis_rightz_antideadzone, &axis_rightz_center, &axis_rightz_deadzone, &axis_rightz_max, &axis_rightz_min,
+    &trigger_left_antideadzone, &trigger_left_deadzone, &trigger_left_max,
+    &trigger_right_antideadzone, &trigger_right_deadzone, &trigger_right_max,
+};
+
+static int calibration_set(const char *val, const struct kernel_param *kp)
+{
+    int values[ARRAY_SIZE(calibration_params)];
+    int i, len, offset = 0;
+
+    for (i = 0; i < ARRAY_SIZE(calibration_params); i++) {
+        if (sscanf(val + offset, "%d%n", &values[i], &len) != 1)
+            return -EINVAL;
+        offset += len;
+    }
+    if (*skip_spaces(val + offset))
+        return -EINVAL;
+
+    mutex_lock(&params_lock);
+    for (i = 0; i < ARRAY_SIZE(calibration_params); i++)
+        *calibration_params[i] = values[i];
+    update_params = 1;
+    mutex_unlock(&params_lock);
+
+    return 0;
+}
+
+static int calibration_get(char *buffer, const struct kernel_param *kp)
+{
+    int i, len = 0;
+
+    mutex_lock(&params_lock);
+    for (i = 0; i < ARRAY_SIZE(calibration_params); i++)
+        len += scnprintf(buffer + len, PAGE_SIZE - len, "%d%c", *calibration_params[i],
+                 (i + 1 < ARRAY_SIZE(calibration_params)) ? ' ' : '\n');
+    mutex_unlock(&params_lock);
+
+    return len;
+}
+
+static const struct kernel_param_ops calibration_ops = {
+    .set = calibration_set,
+    .get = calibration_get,
+};
+
+module_param_cb(calibration, &calibration_ops, NULL, 0660);
+MODULE_PARM_DESC(calibration, "all the calibration parameters at once");
+
 
 static u8 gamepad_data_checksum(const u8 *data, size_t count)
 {
@@ -203,6 +266,8 @@ static void gamepad_input_handler(struct gamepad_device *dev,
     if (!indev)
         return;
 
+    mutex_lock(&params_lock);
+
     if (update_params)
     {
         input_set_abs_params(indev, ABS_X,
@@ -273,6 +338,8 @@ static void gamepad_input_handler(struct gamepad_device *dev,
     input_report_abs(indev, ABS_RY,
             ( abs(value) < axis_righty_deadzone )? 0 : INT_SIGN(value) * ( abs(value) - axis_righty_antideadzone ));
 
+    mutex_unlock(&params_lock);
+
     input_sync(indev);
     prev_states = keys;
 }